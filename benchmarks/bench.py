@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+# pylint: disable=locally-disabled, C0111, line-too-long
+
+"""Benchmarks docker-compose-swarm-mode on a generated stack against the recording fake `docker` CLI.
+
+Measures parsing, merging (including `extends`), command generation, and the wall time and number of `docker`
+invocations of `up`, a second unchanged `up`, `pull` and `rm`. Results are written as JSON so runs on different commits
+can be compared:
+
+    benchmarks/bench.py --services 150 -o before.json
+    benchmarks/bench.py --services 150 -o after.json
+    benchmarks/bench.py --compare before.json after.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import docker_compose_swarm_mode  # pylint: disable=wrong-import-position
+
+def generate(directory, services, networks, volumes, extends_depth, env_size):
+    """Writes a compose file with the given number of services, networks and volumes to `directory`.
+
+    Every service extends the last of a chain of `extends_depth` services in a separate file, has `env_size`
+    environment variables and uses an env file shared by all services.
+    """
+    base = OrderedDict()
+    for level in range(extends_depth):
+        base['base{}'.format(level)] = OrderedDict([('environment', ['BASE{}_{}=value'.format(level, index) for index in range(env_size)])])
+        if level:
+            base['base{}'.format(level)]['extends'] = {'service': 'base{}'.format(level - 1)}
+
+    compose = OrderedDict([('version', '3'), ('services', OrderedDict()),
+                           ('networks', OrderedDict(('net{}'.format(index), None) for index in range(networks))),
+                           ('volumes', OrderedDict(('vol{}'.format(index), {'driver': 'local', 'driver_opts': {}}) for index in range(volumes)))])
+    for index in range(services):
+        service = OrderedDict([('image', 'registry.example.com/app{}:1.0'.format(index % 20))])
+        if extends_depth:
+            service['extends'] = {'file': 'base.yml', 'service': 'base{}'.format(extends_depth - 1)}
+        service['environment'] = ['SERVICE_{}_{}=value'.format(index, env) for env in range(env_size)]
+        service['env_file'] = ['common.env']
+        if networks:
+            service['networks'] = ['net{}'.format(index % networks)]
+        if volumes:
+            service['volumes'] = ['vol{}:/data'.format(index % volumes)]
+        service['ports'] = ['{}:80'.format(10000 + index)]
+        service['deploy'] = OrderedDict([('replicas', 2), ('placement', {'constraints': ['node.role == worker']}),
+                                         ('restart_policy', {'condition': 'on-failure', 'delay': '5s'})])
+        if index and index % 10:
+            service['depends_on'] = ['service{}'.format(index - 1)]
+        compose['services']['service{}'.format(index)] = service
+
+    dump(compose, os.path.join(directory, 'docker-compose.yml'))
+    dump({'services': base}, os.path.join(directory, 'base.yml'))
+    with open(os.path.join(directory, 'common.env'), 'w') as env_file:
+        env_file.write(''.join('COMMON_{}=value\n'.format(index) for index in range(env_size)))
+
+def dump(data, path):
+    def represent_ordered_dict(dumper, value):
+        return dumper.represent_mapping(u'tag:yaml.org,2002:map', value.items())
+    yaml.add_representer(OrderedDict, represent_ordered_dict)
+    with open(path, 'w') as output:
+        yaml.dump(data, output, default_flow_style=False)
+
+def best_of(repeat, function):
+    result = None
+    for _ in range(repeat):
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+        result = elapsed if result is None else min(result, elapsed)
+    return result
+
+def measure_phases(directory, repeat):
+    path = os.path.join(directory, 'docker-compose.yml')
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        parse = best_of(repeat, lambda: docker_compose_swarm_mode.ComposeLoader().load(path))
+        compose = docker_compose_swarm_mode.ComposeLoader().load(path)
+        merge = best_of(repeat, lambda: docker_compose_swarm_mode.DockerCompose(compose, 'bench', directory + '/', []))
+
+        def generate_commands():
+            docker_compose = docker_compose_swarm_mode.DockerCompose(compose, 'bench', directory + '/', [])
+            for service in docker_compose.services:
+                docker_compose.service_spec(service)
+        commands = best_of(repeat, generate_commands) - merge
+    finally:
+        os.chdir(cwd)
+    return OrderedDict([('parse_seconds', parse), ('merge_seconds', merge), ('command_generation_seconds', commands)])
+
+def run_command(directory, args, latency):
+    """Runs the tool with the fake docker CLI first on PATH; returns its wall time and the docker invocations it made."""
+    log = os.path.join(directory, 'docker.log')
+    if os.path.exists(log):
+        os.remove(log)
+    env = dict(os.environ, PATH=os.path.join(directory, 'bin') + os.pathsep + os.environ.get('PATH', ''),
+               FAKE_DOCKER_STATE=os.path.join(directory, 'state.json'), FAKE_DOCKER_LOG=log, FAKE_DOCKER_LATENCY=str(latency))
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        returncode = subprocess.call([sys.executable, os.path.join(ROOT, 'docker_compose_swarm_mode.py')] + args,
+                                     cwd=directory, env=env, stdout=devnull, stderr=devnull)
+    elapsed = time.time() - start
+    calls = sum(1 for _ in open(log)) if os.path.exists(log) else 0
+    return OrderedDict([('seconds', elapsed), ('docker_calls', calls), ('returncode', returncode)])
+
+def git_commit():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def benchmark(args):
+    directory = tempfile.mkdtemp(prefix='dcsm-bench-')
+    try:
+        generate(directory, args.services, args.networks, args.volumes, args.extends_depth, args.env_size)
+        os.mkdir(os.path.join(directory, 'bin'))
+        os.symlink(os.path.join(ROOT, 'benchmarks', 'fake-docker'), os.path.join(directory, 'bin', 'docker'))
+
+        results = OrderedDict()
+        results['commit'] = git_commit()
+        results['python'] = platform.python_version()
+        results['params'] = OrderedDict((name, getattr(args, name)) for name in ('services', 'networks', 'volumes', 'extends_depth', 'env_size', 'latency', 'parallel'))
+        results['phases'] = measure_phases(directory, args.repeat)
+        results['commands'] = OrderedDict()
+        for name, command in (('up', ['up', '--parallel', str(args.parallel)]),
+                              ('up_unchanged', ['up', '--parallel', str(args.parallel)]),
+                              ('pull', ['pull']),
+                              ('rm', ['rm'])):
+            results['commands'][name] = run_command(directory, command, args.latency)
+        return results
+    finally:
+        shutil.rmtree(directory)
+
+def flatten(results):
+    metrics = OrderedDict(('phases.' + name, value) for name, value in results['phases'].items())
+    for command, result in results['commands'].items():
+        metrics['{}.seconds'.format(command)] = result['seconds']
+        metrics['{}.docker_calls'.format(command)] = result['docker_calls']
+    return metrics
+
+def compare(old_path, new_path):
+    with open(old_path) as old_file, open(new_path) as new_file:
+        old, new = flatten(json.load(old_file, object_pairs_hook=OrderedDict)), flatten(json.load(new_file, object_pairs_hook=OrderedDict))
+    print '{:<36} {:>12} {:>12} {:>9}'.format('METRIC', 'OLD', 'NEW', 'CHANGE')
+    for metric in old:
+        if metric in new:
+            change = '{:+.1f}%'.format((new[metric] - old[metric]) * 100.0 / old[metric]) if old[metric] else '-'
+            print '{:<36} {:>12.4g} {:>12.4g} {:>9}'.format(metric, old[metric], new[metric], change)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--services', type=int, default=50)
+    parser.add_argument('--networks', type=int, default=5)
+    parser.add_argument('--volumes', type=int, default=5)
+    parser.add_argument('--extends-depth', type=int, default=3)
+    parser.add_argument('--env-size', type=int, default=20, help='Number of environment variables per service and env file')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds every fake docker invocation takes')
+    parser.add_argument('--parallel', type=int, default=1, help='Value of up --parallel')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of repetitions of the in-process phases (the best is reported)')
+    parser.add_argument('-o', '--output', help='Write the results to this file instead of stdout')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='Compare two result files')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    output = json.dumps(benchmark(args), indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print output
+
+if __name__ == '__main__':
+    main()
@@ -3,10 +3,31 @@
 # pylint: disable=locally-disabled, C0111, line-too-long
 
 import argparse
+import base64
+import contextlib
+import copy
+import cPickle
+import ctypes
+import ctypes.util
+import functools
+import hashlib
+import httplib
+import json
 import os
+import pipes
+import Queue
+import re
+import select
+import signal
+import socket
+import ssl
+import struct
 import subprocess
 import sys
+import tempfile
 import threading
+import time
+import urllib
 from collections import OrderedDict, deque
 
 import yaml
@@ -14,343 +35,2251 @@ import yodl
 
 DEBUG = False
 
-class DockerCompose(object):
-    def __init__(self, compose, project, compose_base_dir, requested_services):
-        self.project = project
-        self.compose_base_dir = compose_base_dir
-        self.services = self.merge_services(compose.get('services', {}))
-        self.networks = compose.get('networks', {})
-        self.volumes = compose.get('volumes', {})
-        self.filtered_services = [service for service in self.services if not requested_services or service in requested_services]
+SPEC_HASH_LABEL = 'docker-compose-swarm-mode.spec-hash'
+SPEC_LABEL = 'docker-compose-swarm-mode.spec'
+PLAN_VERSION = 1
+WAIT_INTERVAL = 2
+LOG_BUFFER = 1000
+LOG_DELAY = 0.2
+WATCH_INTERVAL = 2
+WATCH_DEBOUNCE = 0.5
+VARIABLE_PATTERN = re.compile(r'\$(?:(?P<escaped>\$)|(?P<named>[_a-zA-Z][_a-zA-Z0-9]*)|'
+                              r'\{(?P<braced>[_a-zA-Z][_a-zA-Z0-9]*)(?:(?P<operator>:?[-?])(?P<argument>[^}]*))?\}|(?P<invalid>))')
+
+# Flags that `docker service update` changes with `<flag>-add`/`<flag>-rm`, mapped to the function that returns the
+# key `<flag>-rm` expects for a value.
+UPDATE_LIST_FLAGS = {
+    '--constraint': lambda value: value,
+    '--env': lambda value: value.split('=', 1)[0],
+    '--host': lambda value: value,
+    '--label': lambda value: value.split('=', 1)[0],
+    '--mount': lambda value: dict(part.split('=', 1) for part in value.split(',')).get('dst'),
+    '--network': lambda value: value,
+    '--publish': lambda value: str(value).split(':')[-1],
+}
+
+# List flags whose `<flag>-add` does not replace the value with the same key, so a changed value is removed first.
+UPDATE_REPLACED_FLAGS = set(['--publish'])
+
+# Flags to pass to `docker service update` when a single-valued flag is no longer set.
+UPDATE_RESETS = {
+    '--health-interval': ['--health-interval', '0s'],
+    '--health-retries': ['--health-retries', 0],
+    '--health-timeout': ['--health-timeout', '0s'],
+    '--hostname': ['--hostname', ''],
+    '--limit-memory': ['--limit-memory', '0'],
+    '--no-healthcheck': ['--no-healthcheck=false', None],
+    '--restart-condition': ['--restart-condition', 'any'],
+    '--restart-delay': ['--restart-delay', '5s'],
+    '--restart-max-attempts': ['--restart-max-attempts', 0],
+    '--restart-window': ['--restart-window', '0s'],
+    '--update-delay': ['--update-delay', '0s'],
+    '--update-failure-action': ['--update-failure-action', 'pause'],
+    '--update-max-failure-ratio': ['--update-max-failure-ratio', 0],
+    '--update-monitor': ['--update-monitor', '0s'],
+    '--update-parallelism': ['--update-parallelism', 1],
+}
+
+class ComposeError(Exception):
+    pass
+
+class SkippedError(ComposeError):
+    """A job that was not run because the job `dependency` failed."""
+
+    def __init__(self, dependency):
+        super(SkippedError, self).__init__('skipped: dependency {} failed'.format(dependency))
+        self.dependency = dependency
+
+class OperationsError(ComposeError):
+    """Operations that failed or were skipped; `errors` maps their keys to the exceptions."""
+
+    def __init__(self, errors):
+        failed = ['{}: {}'.format(key, self.reason(error)) for key, error in errors.items() if not isinstance(error, SkippedError)]
+        skipped = [key for key, error in errors.items() if isinstance(error, SkippedError)]
+        super(OperationsError, self).__init__('; '.join(failed + (['skipped ' + ', '.join(skipped)] if skipped else [])))
+        self.errors = errors
 
-    def project_prefix(self, value):
-        return '{}_{}'.format(self.project, value) if self.project else value
+    @staticmethod
+    def reason(error):
+        """Returns the last line of the output of a failed command, the message of anything else."""
+        if isinstance(error, CommandError):
+            lines = str(error.output or '').strip().splitlines()
+            return lines[-1] if lines else 'exit status {}'.format(error.returncode)
+        return str(error).strip()
+
+class CommandError(Exception):
+    def __init__(self, cmd, returncode, output):
+        super(CommandError, self).__init__(cmd, returncode, output)
+        self.cmd = cmd
+        self.returncode = returncode
+        self.output = output
+
+    def __str__(self):
+        return 'command "{}" failed: {}'.format(self.cmd, self.output)
+
+class Output(object):
+    """Serializes output written from several threads and prefixes it with the label of the writing thread.
+
+    Labels are set with `labeled()` around work that runs concurrently with other work, e.g. parallel creates or pulls.
+    Nested labels are all shown, outermost first.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._local = threading.local()
+
+    def labels(self):
+        return getattr(self._local, 'labels', ())
+
+    @contextlib.contextmanager
+    def labeled(self, *labels):
+        previous = self.labels()
+        self._local.labels = previous + labels
+        try:
+            yield
+        finally:
+            self._local.labels = previous
+
+    def write(self, text, stream=None):
+        labels = self.labels()
+        if labels:
+            prefix = ''.join('[{}] '.format(label) for label in labels)
+            text = ''.join(prefix + line for line in text.splitlines(True))
+        with self.lock:
+            (stream or sys.stdout).write(text if text.endswith('\n') else text + '\n')
+            (stream or sys.stdout).flush()
+
+OUTPUT = Output()
+
+class NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **args):
+        pass
+
+class NullTracer(object):
+    """Tracer used when tracing is off; every call is a no-op."""
+
+    span_instance = NullSpan()
+
+    def span(self, name, category, **args):  # pylint: disable=unused-argument
+        return self.span_instance
+
+    def add(self, name, category, start, end, **args):
+        pass
+
+class Span(object):
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.args['error'] = str(exc_value)
+        self.tracer.add(self.name, self.category, self.start, time.time(), **self.args)
+        return False
+
+    def set(self, **args):
+        self.args.update(args)
+
+class Tracer(object):
+    """Records spans of the run phases, service operations, docker commands and API requests.
+
+    The spans are written as Chrome trace events (for chrome://tracing or Perfetto), together with a JSON summary of
+    the phases, the slowest services and commands and the time spent waiting on the manager.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+        self.start = time.time()
+
+    def span(self, name, category, **args):
+        return Span(self, name, category, args)
+
+    def add(self, name, category, start, end, **args):
+        event = {'name': name, 'cat': category, 'ph': 'X', 'ts': int((start - self.start) * 10 ** 6), 'dur': int((end - start) * 10 ** 6),
+                 'pid': os.getpid(), 'tid': threading.current_thread().ident, 'args': args}
+        with self.lock:
+            self.events.append(event)
+
+    def summary(self):
+        def slowest(categories, count=10):
+            events = sorted((event for event in self.events if event['cat'] in categories), key=lambda event: -event['dur'])[:count]
+            return [OrderedDict([('name', event['name']), ('seconds', event['dur'] / 10.0 ** 6)] + sorted(event['args'].items()))
+                    for event in events]
+
+        # Concurrent requests overlap, so the wall time waiting on the manager is the length of the union of the spans.
+        intervals = sorted((event['ts'], event['ts'] + event['dur']) for event in self.events if event['cat'] in ('docker', 'api'))
+        wall, end = 0, None
+        for interval_start, interval_end in intervals:
+            if end is None or interval_start > end:
+                wall += interval_end - interval_start
+                end = interval_end
+            elif interval_end > end:
+                wall += interval_end - end
+                end = interval_end
+
+        return OrderedDict([
+            ('total_seconds', time.time() - self.start),
+            ('phases', OrderedDict((event['name'], event['dur'] / 10.0 ** 6) for event in self.events if event['cat'] == 'phase')),
+            ('manager_calls', len(intervals)),
+            ('manager_wait_seconds', sum(interval_end - interval_start for interval_start, interval_end in intervals) / 10.0 ** 6),
+            ('manager_wall_seconds', wall / 10.0 ** 6),
+            ('slowest_services', slowest(('service', 'network', 'volume', 'pull'))),
+            ('slowest_calls', slowest(('docker', 'api'))),
+        ])
+
+    def write(self, path):
+        with open(path, 'w') as trace_file:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, trace_file)
+        with open(os.path.splitext(path)[0] + '.summary.json', 'w') as summary_file:
+            json.dump(self.summary(), summary_file, indent=2)
+
+TRACER = NullTracer()
+
+class Executor(object):
+    """Runs shell commands, streaming their output line by line as it arrives.
+
+    Every command is limited to `timeout` seconds and all of them together to `total_timeout` seconds; a command that
+    runs out of time is killed together with its children. The latency and exit status of every command is recorded
+    with TRACER.
+    """
+
+    def __init__(self, timeout=None, total_timeout=None):
+        self.timeout = timeout
+        self.deadline = time.time() + total_timeout if total_timeout else None
+
+    def remaining_timeout(self, cmd):
+        """Returns the time the next command may take (None if unlimited), raising CommandError once the deadline passed."""
+        timeout = self.timeout
+        if self.deadline is not None:
+            remaining = self.deadline - time.time()
+            if remaining <= 0:
+                raise CommandError(cmd, 124, 'overall timeout exceeded')
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        return timeout
+
+    def run(self, cmd, ignore_return_code=False, stream=False):
+        """Runs the command and returns its stdout. With `stream` set, its output is also written as it arrives."""
+        OUTPUT.write('Running: \n' + cmd + '\n')
+        if DEBUG:
+            return None
+
+        timeout = self.remaining_timeout(cmd)
+        start = time.time()
+        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=os.setsid)
+        stdout, output = [], []
+        labels = OUTPUT.labels()
+
+        def read(pipe, lines, stream_to):
+            with OUTPUT.labeled(*labels):
+                for line in iter(pipe.readline, ''):
+                    lines.append(line)
+                    if lines is not output:
+                        output.append(line)
+                    if stream:
+                        OUTPUT.write(line, stream_to)
+            pipe.close()
+
+        readers = [threading.Thread(target=read, args=(proc.stdout, stdout, sys.stdout)),
+                   threading.Thread(target=read, args=(proc.stderr, output, sys.stderr))]
+        for reader in readers:
+            reader.daemon = True
+            reader.start()
+
+        timed_out = []
+
+        def kill():
+            timed_out.append(True)
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass  # already finished
+
+        timer = threading.Timer(timeout, kill) if timeout else None
+        if timer:
+            timer.daemon = True
+            timer.start()
+        try:
+            for reader in readers:
+                while reader.is_alive():
+                    reader.join(1)
+            returncode = proc.wait()
+        finally:
+            if timer:
+                timer.cancel()
+
+        end = time.time()
+        TRACER.add(cmd.split('\n')[0][:80], 'docker', start, end, cmd=cmd, returncode=returncode, output_bytes=sum(len(line) for line in output))
+        if timed_out:
+            raise CommandError(cmd, 124, 'timed out after {:.1f}s\n{}'.format(timeout, ''.join(output)))
+        if returncode != 0 and not ignore_return_code:
+            raise CommandError(cmd, returncode, ''.join(output))
+        return ''.join(stdout)
+
+    def lines(self, cmd):
+        """Runs the command without a time limit and yields its output (stdout and stderr) line by line as it arrives."""
+        OUTPUT.write('Running: \n' + cmd + '\n')
+        if DEBUG:
+            return
+
+        start = time.time()
+        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = deque(maxlen=20)
+        try:
+            for line in iter(proc.stdout.readline, ''):
+                output.append(line)
+                yield line
+        finally:
+            proc.stdout.close()
+            if proc.poll() is None:
+                proc.kill()  # the consumer stopped reading
+        returncode = proc.wait()
+
+        end = time.time()
+        TRACER.add(cmd.split('\n')[0][:80], 'docker', start, end, cmd=cmd, returncode=returncode)
+        if returncode != 0:
+            raise CommandError(cmd, returncode, ''.join(output))
+
+class CliBackend(object):
+    """Executes operations by running `docker` CLI commands through `call`, against the manager at `host` if given."""
+
+    def __init__(self, call, host=None, lines=None):
+        self.call = call
+        self.lines = lines
+        self.docker = 'docker -H {}'.format(host) if host else 'docker'
+        self._service_names = {}
 
-    def merge_services(self, services):
-        result = OrderedDict()
+    @staticmethod
+    def parse_names(output):
+        names = set()
+        for line in (output or '').splitlines()[1:]:
+            columns = line.split()
+            if len(columns) > 1:
+                names.add(columns[1])
+        return names
+
+    def list(self, kind):
+        return self.parse_names(self.call(self.docker + ' {} ls'.format(kind)))
+
+    def network_names(self):
+        """Returns the names of the networks by ID."""
+        lines = (self.call(self.docker + ' network ls --no-trunc') or '').splitlines()[1:]
+        return dict(line.split()[:2] for line in lines if len(line.split()) > 1)
+
+    def inspect_services(self, names):
+        output = self.call(self.docker + ' service inspect ' + ' '.join(names))
+        return [item['Spec'] for item in json.loads(output)] if output else []
+
+    def nodes(self):
+        ids = (self.call(self.docker + ' node ls -q') or '').split()
+        output = self.call(self.docker + ' node inspect ' + ' '.join(ids)) if ids else None
+        return json.loads(output) if output else []
+
+    def create_network(self, name, driver, options):
+        self.call(self.docker + ' network create --driver {} {}{}'.format(driver, format_options(options), name), stream=True)
+
+    def create_volume(self, name, driver, options):
+        cmd = self.docker + ' volume create --name {0}'.format(name)
+        if driver:
+            cmd = cmd + ' --driver={0}'.format(driver)
+        for opt, value in options.items():
+            cmd = cmd + ' \\\n --opt {}={}'.format(opt, value)
+        self.call(cmd, stream=True)
+
+    def create_service(self, name, flags, image, command):
+        cmd = [self.docker + ' service create --with-registry-auth \\\n --name', name, '\\\n']
+        for key, value in flags:
+            cmd.extend(format_flag(key, value))
+        cmd.append(image)
+        cmd.extend(command)
+        self.call(' '.join(cmd), stream=True)
+
+    def update_service(self, name, update_flags, flags, image, command):  # pylint: disable=unused-argument
+        cmd = [self.docker + ' service update --with-registry-auth \\\n']
+        for key, value in update_flags:
+            cmd.extend(format_flag(key, value))
+        cmd.append(name)
+        self.call(' '.join(cmd), stream=True)
+
+    def scale(self, replicas):
+        self.call(self.docker + ' service scale ' + ' '.join('{}={}'.format(name, count) for name, count in replicas.items()), stream=True)
+
+    def remove_services(self, names):
+        self.call(self.docker + ' service rm ' + ' '.join(names), stream=True)
+
+    def pull(self, node, image):
+        """Pulls the image on the node; the CLI does not tell how many bytes were downloaded, so returns None."""
+        self.call('docker -H tcp://{}:2375 pull {}'.format(node, image), stream=True)
+
+    def inspect_image(self, node, image):
+        output = self.call('docker -H tcp://{}:2375 inspect --type image {}'.format(node, image), ignore_return_code=True)
+        try:
+            return json.loads(output)[0] if output else None
+        except (ValueError, IndexError):
+            return None
+
+    def distribution_digest(self, image):  # pylint: disable=unused-argument
+        return None  # the CLI can not resolve a tag without pulling it
+
+    def tasks(self, names):
+        """Returns the tasks of the given services as an ordered mapping of service name to Engine API task objects."""
+        if any(name not in self._service_names.values() for name in names):
+            output = self.call(self.docker + ' service inspect ' + ' '.join(names))
+            self._service_names.update((item['ID'], item['Spec']['Name']) for item in json.loads(output or '[]'))
+        ids = (self.call(self.docker + ' service ps -q --no-trunc ' + ' '.join(names)) or '').split()
+        output = self.call(self.docker + ' inspect --type task ' + ' '.join(ids)) if ids else None
+        return group_tasks(names, json.loads(output) if output else [], self._service_names)
+
+    def deploy_stack(self, name, data):
+        """Deploys the stack file `data` as the stack `name`."""
+        if DEBUG:
+            OUTPUT.write(data)
+        fd, path = tempfile.mkstemp(suffix='.yml')
+        try:
+            with os.fdopen(fd, 'w') as stack_file:
+                stack_file.write(data)
+            self.call(self.docker + ' stack deploy --with-registry-auth --compose-file {} {}'.format(path, name), stream=True)
+        finally:
+            os.remove(path)
+
+    def logs(self, name, follow=False, tail=None):
+        """Yields `(timestamp, line)` for the log lines of the service."""
+        cmd = self.docker + ' service logs --timestamps{}{} {}'.format(' --follow' if follow else '', ' --tail {}'.format(tail) if tail else '', name)
+        for line in self.lines(cmd):
+            match = re.match(r'(\S+) \S+@\S+\s+\| ?(.*)', line.rstrip('\n'))
+            if match:
+                yield log_timestamp(match.group(1)), match.group(2)
+            else:
+                timestamp, _, text = line.rstrip('\n').partition(' ')
+                yield log_timestamp(timestamp), text
+
+class ApiError(CommandError):
+    pass
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    def __init__(self, path, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):  # pylint: disable=protected-access
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:  # pylint: disable=protected-access
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+class EngineClient(object):
+    """Minimal Docker Engine API client.
+
+    Every thread keeps its own persistent keep-alive connection to `host` (`unix://` path or `tcp://` address, defaulting
+    to `DOCKER_HOST` and then to the local socket). TLS is used the same way the docker CLI does: when
+    `DOCKER_TLS_VERIFY` is set, with the certificates from `DOCKER_CERT_PATH`.
+    """
+
+    def __init__(self, host=None, version=None):
+        self.host = host or os.environ.get('DOCKER_HOST') or 'unix:///var/run/docker.sock'
+        self.version = version or 'v' + os.environ.get('DOCKER_API_VERSION', '1.24')
+        self._local = threading.local()
+
+    def connect(self):
+        if self.host.startswith('unix://'):
+            return UnixHTTPConnection(self.host[len('unix://'):])
+        address = self.host.split('://', 1)[-1].rstrip('/')
+        if os.environ.get('DOCKER_TLS_VERIFY'):
+            cert_path = os.environ.get('DOCKER_CERT_PATH') or os.path.expanduser('~/.docker')
+            context = ssl.create_default_context(cafile=os.path.join(cert_path, 'ca.pem'))
+            context.check_hostname = False
+            context.load_cert_chain(os.path.join(cert_path, 'cert.pem'), os.path.join(cert_path, 'key.pem'))
+            return httplib.HTTPSConnection(address, context=context)
+        return httplib.HTTPConnection(address)
+
+    def request(self, method, path, query=None, body=None, headers=None, raw=False, timeout=None):
+        url = '/{}{}'.format(self.version, path)
+        if query:
+            url += '?' + urllib.urlencode(query)
+        headers = dict(headers or {})
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+
+        start = time.time()
+        for attempt in range(2):
+            connection = getattr(self._local, 'connection', None)
+            reused = connection is not None
+            if connection is None:
+                connection = self._local.connection = self.connect()
+            connection.timeout = timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+            try:
+                connection.request(method, url, body, headers)
+                response = connection.getresponse()
+                data = response.read()
+                break
+            except (httplib.HTTPException, socket.error) as e:
+                connection.close()
+                self._local.connection = None
+                # The daemon may have closed an idle keep-alive connection, so retry once on a fresh one.
+                if not reused or attempt or isinstance(e, socket.timeout):
+                    raise self.connection_error(method, url, e)
+
+        TRACER.add('{} {}'.format(method, path), 'api', start, time.time(), host=self.host, status=response.status, output_bytes=len(data))
+        if response.status >= 400:
+            try:
+                message = json.loads(data).get('message', data)
+            except ValueError:
+                message = data
+            raise ApiError('{} {}'.format(method, url), response.status, message)
+        if raw:
+            return data
+        return json.loads(data) if data else None
+
+    def stream(self, method, path, query=None, version=None):
+        """Sends the request on a connection of its own and returns the response to be read as the body arrives."""
+        url = '/{}{}'.format(version or self.version, path)
+        if query:
+            url += '?' + urllib.urlencode(query)
+        connection = self.connect()
+        try:
+            connection.request(method, url)
+            response = connection.getresponse()
+        except (httplib.HTTPException, socket.error) as e:
+            connection.close()
+            raise self.connection_error(method, url, e)
+        if response.status >= 400:
+            data = response.read()
+            connection.close()
+            try:
+                message = json.loads(data).get('message', data)
+            except ValueError:
+                message = data
+            raise ApiError('{} {}'.format(method, url), response.status, message)
+        return response
+
+    def connection_error(self, method, url, error):
+        """Returns the ApiError for a request that failed without a response, so it is reported and retried like others."""
+        return ApiError('{} {}'.format(method, url), 1, 'request to {} failed: {}'.format(self.host, str(error) or type(error).__name__))
+
+class ApiBackend(object):
+    """Executes operations through the Docker Engine API instead of the CLI."""
+
+    def __init__(self, host=None, executor=None):
+        self.client = EngineClient(host)
+        self.executor = executor or Executor()
+        self._node_clients = {}
+        self._service_names = {}
+
+    def request(self, method, path, query=None, body=None, headers=None):
+        if DEBUG:
+            OUTPUT.write('Running: \n{} {}{}\n'.format(method, path, '\n' + json.dumps(body, indent=2) if body is not None else ''))
+            return None
+        return self.client.request(method, path, query, body, headers, timeout=self.executor.remaining_timeout('{} {}'.format(method, path)))
+
+    def list(self, kind):
+        if kind == 'volume':
+            return set(volume['Name'] for volume in (self.request('GET', '/volumes') or {}).get('Volumes') or [])
+        names = set()
+        for item in self.request('GET', '/{}s'.format(kind)) or []:
+            names.add(item['Spec']['Name'] if kind == 'service' else item['Name'])
+        return names
+
+    def network_names(self):
+        return dict((network['Id'], network['Name']) for network in self.request('GET', '/networks') or [])
+
+    def inspect_services(self, names):
+        services = self.request('GET', '/services', {'filters': json.dumps({'name': names})}) or []
+        return [service['Spec'] for service in services if service['Spec']['Name'] in names]
+
+    def nodes(self):
+        return self.request('GET', '/nodes') or []
+
+    def create_network(self, name, driver, options):
+        self.request('POST', '/networks/create', body={
+            'Name': name, 'Driver': driver, 'CheckDuplicate': True,
+            'Options': dict((key, '' if value is None else str(value)) for key, value in options.items())})
+
+    def create_volume(self, name, driver, options):
+        self.request('POST', '/volumes/create', body={
+            'Name': name, 'Driver': driver or 'local', 'DriverOpts': dict((key, str(value)) for key, value in options.items())})
+
+    def create_service(self, name, flags, image, command):
+        self.request('POST', '/services/create', body=service_spec_from_flags(name, flags, image, command),
+                     headers=registry_auth_headers(image))
+
+    def update_service(self, name, update_flags, flags, image, command):  # pylint: disable=unused-argument
+        # The whole spec is replaced; swarm itself only restarts tasks if the task template changed.
+        service = self.request('GET', '/services/' + name)
+        version = service['Version']['Index'] if service else 0
+        self.request('POST', '/services/{}/update'.format(name), {'version': version},
+                     service_spec_from_flags(name, flags, image, command), registry_auth_headers(image))
+
+    def scale(self, replicas):
+        for name, count in replicas.items():
+            service = self.request('GET', '/services/' + name)
+            if service is None or service['Spec'].get('Mode', {}).get('Replicated', {}).get('Replicas') == int(count):
+                continue
+            spec = service['Spec']
+            spec['Mode'] = {'Replicated': {'Replicas': int(count)}}
+            self.request('POST', '/services/{}/update'.format(name), {'version': service['Version']['Index']}, spec)
+
+    def remove_services(self, names):
+        for name in names:
+            self.request('DELETE', '/services/' + name)
+
+    def node_request(self, node, method, path, query=None, headers=None, raw=False):
+        if DEBUG:
+            OUTPUT.write('Running: \n{} tcp://{}:2375{}{}\n'.format(method, node, path, '?' + urllib.urlencode(query) if query else ''))
+            return None
+        if node not in self._node_clients:
+            self._node_clients[node] = EngineClient('tcp://{}:2375'.format(node))
+        return self._node_clients[node].request(method, path, query, headers=headers, raw=raw,
+                                                timeout=self.executor.remaining_timeout('{} {}'.format(method, path)))
+
+    def pull(self, node, image):
+        """Pulls the image on the node and returns the number of bytes downloaded."""
+        name, tag = split_image_tag(image)
+        output = self.node_request(node, 'POST', '/images/create', {'fromImage': name, 'tag': tag}, registry_auth_headers(image), raw=True)
+        layers = {}
+        for line in (output or '').splitlines():
+            if not line.strip():
+                continue
+            message = json.loads(line)
+            if 'error' in message:
+                raise ApiError('pull {} on {}'.format(image, node), 1, message['error'])
+            if message.get('status') == 'Downloading' and (message.get('progressDetail') or {}).get('total'):
+                layers[message['id']] = message['progressDetail']['total']
+        return sum(layers.values())
+
+    def inspect_image(self, node, image):
+        try:
+            return self.node_request(node, 'GET', '/images/{}/json'.format(image))
+        except ApiError as e:
+            if e.returncode == 404:
+                return None
+            raise
 
-        for service in services:
-            service_config = services[service]
-            result[service] = service_config
+    def distribution_digest(self, image):
+        try:
+            descriptor = self.request('GET', '/distribution/{}/json'.format(image), headers=registry_auth_headers(image))
+        except ApiError:
+            return None  # the daemon is too old or the registry is unreachable, the image is just pulled then
+        return descriptor['Descriptor']['digest'] if descriptor else None
+
+    def tasks(self, names):
+        if any(name not in self._service_names.values() for name in names):
+            services = self.request('GET', '/services', {'filters': json.dumps({'name': names})}) or []
+            self._service_names.update((service['ID'], service['Spec']['Name']) for service in services)
+        ids = [key for key, name in self._service_names.items() if name in names]
+        tasks = self.request('GET', '/tasks', {'filters': json.dumps({'service': ids})}) if ids else None
+        return group_tasks(names, tasks or [], self._service_names)
+
+    def deploy_stack(self, name, data):
+        # Stacks are implemented by the docker CLI on top of the API, there is no endpoint to deploy one.
+        CliBackend(self.executor.run, self.client.host).deploy_stack(name, data)
+
+    def logs(self, name, follow=False, tail=None):
+        path = '/services/{}/logs'.format(name)
+        if DEBUG:
+            OUTPUT.write('Running: \nGET {}\n'.format(path))
+            return
+
+        # Service logs are only available from API version 1.29 on.
+        version = self.client.version
+        if tuple(int(part) for part in version.lstrip('v').split('.')) < (1, 29):
+            version = 'v1.29'
+        response = self.client.stream('GET', path, OrderedDict([('stdout', 1), ('stderr', 1), ('timestamps', 1), ('follow', int(follow)),
+                                                                ('tail', tail or 'all')]), version)
+        data = ''
+        try:
+            for frame in read_frames(response):
+                data += frame
+                while '\n' in data:
+                    line, data = data.split('\n', 1)
+                    timestamp, _, text = line.partition(' ')
+                    yield log_timestamp(timestamp), text
+        finally:
+            response.close()
+
+class PullScheduler(object):
+    """Pulls images on nodes, at most `parallel` pulls in total and `per_node` pulls on one node at a time.
+
+    Nodes that already have the digest an image resolves to are skipped. Every pull is recorded in `results` with its
+    duration and the bytes downloaded (None if the backend can not tell).
+    """
+
+    def __init__(self, backend, parallel, per_node):
+        self.backend = backend
+        self.parallel = max(parallel, 1)
+        self.per_node = max(per_node, 1)
+        self.results = []
+        self.seconds = 0
+
+    def resolve_digest(self, image):
+        if '@' in image:
+            return image.split('@', 1)[1]
+        return self.backend.distribution_digest(image)
+
+    def pull(self, node, image, digest):
+        start = time.time()
+        result = OrderedDict([('node', node), ('image', image), ('status', 'pulled'), ('seconds', 0), ('bytes', 0)])
+        try:
+            info = self.backend.inspect_image(node, image) if digest else None
+            if info and any(repo_digest.endswith('@' + digest) for repo_digest in info.get('RepoDigests') or []):
+                result['status'] = 'up to date'
+            else:
+                with OUTPUT.labeled('{} {}'.format(node, image)):
+                    result['bytes'] = self.backend.pull(node, image)
+        except Exception as e:  # pylint: disable=broad-except
+            result['status'] = 'failed'
+            result['error'] = str(e)
+        result['seconds'] = time.time() - start
+        TRACER.add('{} on {}'.format(image, node), 'pull', start, start + result['seconds'], **result)
+        OUTPUT.write('{node}: {image} {status} in {0:.1f}s{1}{2}'.format(
+            result['seconds'], ' ({})'.format(format_bytes(result['bytes'])) if result['bytes'] is not None else '',
+            ': ' + result['error'] if 'error' in result else '', **result))
+        return result
 
-            if 'extends' in service_config:
-                extended_config = service_config['extends']
-                extended_service = extended_config['service']
+    def run(self, targets):
+        """Pulls every image of `targets` (an ordered mapping of image to the nodes to pull it on)."""
+        start = time.time()
+        digests = {}
+        errors = run_parallel(OrderedDict((image, functools.partial(lambda image: digests.update({image: self.resolve_digest(image)}), image))
+                                          for image in targets), {}, self.parallel)
+        for image, error in errors.items():
+            OUTPUT.write('WARNING: can not resolve the digest of {}: {}'.format(image, error), sys.stderr)
+
+        pending = deque((node, image) for image, nodes in targets.items() for node in nodes)
+        running = dict.fromkeys(set(node for node, _ in pending), 0)
+        condition = threading.Condition()
+
+        def next_job():
+            with condition:
+                while pending:
+                    for job in pending:
+                        if running[job[0]] < self.per_node:
+                            pending.remove(job)
+                            running[job[0]] += 1
+                            return job
+                    condition.wait(1)
+                return None
+
+        labels = OUTPUT.labels()
+
+        def worker():
+            with OUTPUT.labeled(*labels):
+                job = next_job()
+                while job:
+                    result = self.pull(job[0], job[1], digests.get(job[1]))
+                    with condition:
+                        self.results.append(result)
+                        running[job[0]] -= 1
+                        condition.notify_all()
+                    job = next_job()
+
+        threads = [threading.Thread(target=worker) for _ in range(min(self.parallel, len(pending)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+        self.seconds = time.time() - start
+
+    def print_summary(self):
+        for key in ('node', 'image'):
+            OUTPUT.write('\n{:<40} {:>7} {:>11} {:>7} {:>9} {:>10}'.format(key.upper(), 'PULLED', 'UP-TO-DATE', 'FAILED', 'TIME', 'BYTES'))
+            for name in OrderedDict.fromkeys(result[key] for result in self.results):
+                results = [result for result in self.results if result[key] == name]
+                OUTPUT.write('{:<40} {:>7} {:>11} {:>7} {:>8.1f}s {:>10}'.format(
+                    name, *([sum(1 for result in results if result['status'] == status) for status in ('pulled', 'up to date', 'failed')] +
+                            [sum(result['seconds'] for result in results), format_bytes(total_bytes(result['bytes'] for result in results))])))
+        downloaded = total_bytes(result['bytes'] for result in self.results)
+        OUTPUT.write('\n{} pulls of {} images on {} nodes in {:.1f}s: {} pulled, {} up to date, {} failed{}'.format(
+            len(self.results), len(set(result['image'] for result in self.results)), len(set(result['node'] for result in self.results)),
+            self.seconds, *([sum(1 for result in self.results if result['status'] == status) for status in ('pulled', 'up to date', 'failed')] +
+                            [', {} downloaded'.format(format_bytes(downloaded)) if downloaded is not None else ''])))
+
+class ClusterState(object):
+    """Snapshot of the services, networks and volumes that exist in the swarm.
+
+    Every list is fetched with a single call the first time it is needed and is then kept up to date
+    as objects are created or removed, so existence checks no longer cost a process and a manager round-trip each.
+    `reload` drops the snapshot, so it is fetched again on the next lookup.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._objects = {}
+        self._specs = {}
+        self._network_names = None
+
+    def objects(self, kind):
+        if kind not in self._objects:
+            self._objects[kind] = self.backend.list(kind)
+        return self._objects[kind]
+
+    def exists(self, kind, name):
+        return name in self.objects(kind)
+
+    def added(self, kind, name):
+        if kind in self._objects:
+            self._objects[kind].add(name)
+
+    def removed(self, kind, name):
+        if kind in self._objects:
+            self._objects[kind].discard(name)
+        self.changed(name)
+
+    def changed(self, name):
+        """Forgets the spec of the service after it was created or updated, so the next lookup inspects it again."""
+        self._specs.pop(name, None)
+
+    def specs(self, services):
+        """Returns the specs of the given existing services, fetched with a single inspect."""
+        services = [service for service in services if self.exists('service', service)]
+        missing = [service for service in services if service not in self._specs]
+        if missing:
+            for spec in self.backend.inspect_services(missing):
+                self._specs[spec['Name']] = spec
+        return dict((service, self._specs[service]) for service in services if service in self._specs)
+
+    def network_names(self):
+        """Returns the names of the networks by ID."""
+        if self._network_names is None:
+            self._network_names = self.backend.network_names()
+        return self._network_names
+
+    def reload(self):
+        self._objects.clear()
+        self._specs.clear()
+        self._network_names = None
+
+if getattr(yaml, '__with_libyaml__', False):
+    class OrderedDictCLoader(yaml.CLoader):  # pylint: disable=too-many-ancestors
+        """yodl.OrderedDictYAMLLoader on top of the libyaml parser."""
+
+        def __init__(self, stream):
+            yaml.CLoader.__init__(self, stream)
+
+            self.add_constructor(u'tag:yaml.org,2002:map', type(self).construct_yaml_map)
+            self.add_constructor(u'tag:yaml.org,2002:omap', type(self).construct_yaml_map)
+
+        construct_yaml_map = yodl.OrderedDictYAMLLoader.construct_yaml_map.im_func
+        construct_mapping = yodl.OrderedDictYAMLLoader.construct_mapping.im_func
+
+    YAML_LOADER = OrderedDictCLoader
+else:
+    YAML_LOADER = yodl.OrderedDictYAMLLoader
+
+class OrderedDictDumper(getattr(yaml, 'CSafeDumper', yaml.SafeDumper)):  # pylint: disable=too-many-ancestors
+    """Safe YAML dumper that keeps the order of OrderedDict keys."""
+
+OrderedDictDumper.add_representer(OrderedDict, lambda dumper, data: dumper.represent_dict(data.items()))
+
+class ComposeLoader(object):
+    """Loads compose files and resolves `extends`.
+
+    Every file is parsed once and every service of a file is resolved once, however many services and `-f` files extend
+    it. The parsed files and resolved services are shared, so they must not be modified.
+    """
+
+    def __init__(self):
+        self._files = {}
+        self._resolved = {}
+
+    def paths(self):
+        return self._files.keys()
+
+    def invalidate(self, paths):
+        """Forgets the given files, so they are parsed again, and every resolved service."""
+        for path in paths:
+            self._files.pop(os.path.abspath(path), None)
+        self._resolved.clear()
+
+    def load(self, path, compose_file=None):
+        path = os.path.abspath(path)
+        if path not in self._files:
+            if compose_file is None:
+                with open(path) as compose_file:
+                    self._files[path] = yaml.load(compose_file, YAML_LOADER) or {}
+            else:
+                self._files[path] = yaml.load(compose_file, YAML_LOADER) or {}
+        return self._files[path]
 
-                del result[service]['extends']
+    @staticmethod
+    def extends_target(key, config, base_dir):
+        """Returns the `(path, service)` the service identified by `key` extends, or None."""
+        extends = config.get('extends')
+        if not extends:
+            return None
+        if not isinstance(extends, dict):
+            extends = {'service': extends}
+        if 'file' in extends:
+            return os.path.abspath(os.path.join(base_dir, extends['file'])), extends['service']
+        return key[0], extends['service']
+
+    def resolve_services(self, services, base_dir, path=None):
+        """Returns `services` with `extends` resolved.
+
+        `services` come from the file at `path`, or from the merged `-f` files for None, and relative paths of extended
+        files are resolved against `base_dir`.
+        """
+        resolved = dict(self._resolved)
+        configs = {}
+        graph = OrderedDict()
+        stack = [((path, service), services[service], base_dir) for service in reversed(services.keys())]
+
+        while stack:
+            key, config, directory = stack.pop()
+            if key in graph or key in resolved:
+                continue
+            configs[key] = config
+            target = self.extends_target(key, config, directory)
+            graph[key] = [target] if target else []
+            if target and target not in graph and target not in resolved:
+                source = services if target[0] == path else self.load(target[0]).get('services') or {}
+                if target[1] not in source:
+                    raise ComposeError('service "{}" extended by "{}" is not defined in {}'.format(target[1], key[1], target[0] or 'compose file'))
+                stack.append((target, source[target[1]], directory if target[0] == path else os.path.dirname(target[0])))
+
+        for key in topological_sort(graph, lambda key: '{} ({})'.format(key[1], key[0] or 'compose file')):
+            config = configs[key]
+            if graph[key]:
+                config = merge(OrderedDict((name, value) for name, value in config.items() if name != 'extends'), resolved[graph[key][0]],
+                               None, DockerCompose.merge_env)
+            resolved[key] = config
+            if key[0] is not None:
+                self._resolved[key] = config
+
+        return OrderedDict((service, resolved[(path, service)]) for service in services)
+
+class ModelCache(object):
+    """Opt-in on-disk cache of the merged and resolved compose model and of the translated service specs.
+
+    Entries are keyed by the `-f` files, the project name and the working directory. An entry is only used while every
+    file it was built from (compose files, extended files, env files and `.env`) and every COMPOSE_* environment
+    variable is unchanged, and so is every variable the model interpolates; a file whose mtime or size changed is hashed
+    again before the entry is given up.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory or os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                                                   'docker-compose-swarm-mode')
 
-                if 'file' in extended_config:
-                    extended_service_data = self.merge_services(
-                        yaml.load(open(self.compose_base_dir + extended_config['file'], 'r'), yodl.OrderedDictYAMLLoader)['services']
-                    )[extended_service]
-                else:
-                    extended_service_data = result[extended_service]
+    @staticmethod
+    def key(paths, project):
+        module = os.stat(__file__)
+        data = json.dumps([[os.path.abspath(path) for path in paths], project, os.getcwd(), module.st_mtime, module.st_size])
+        return hashlib.sha1(data).hexdigest()
+
+    @staticmethod
+    def environment():
+        return dict((name, value) for name, value in os.environ.items() if name.startswith('COMPOSE_'))
+
+    @staticmethod
+    def fingerprints(paths):
+        result = {}
+        for path in paths:
+            if os.path.isfile(path):
+                status = os.stat(path)
+                with open(path, 'rb') as input_file:
+                    result[path] = [status.st_mtime, status.st_size, hashlib.sha1(input_file.read()).hexdigest()]
+            else:
+                result[path] = None
+        return result
 
-                merge(result[service], extended_service_data, None, self.merge_env)
+    @staticmethod
+    def unchanged(path, fingerprint):
+        if not os.path.isfile(path) or fingerprint is None:
+            return not os.path.isfile(path) and fingerprint is None
+        status = os.stat(path)
+        if [status.st_mtime, status.st_size] == fingerprint[:2]:
+            return True
+        with open(path, 'rb') as input_file:
+            return hashlib.sha1(input_file.read()).hexdigest() == fingerprint[2]
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.directory, key), 'rb') as cache_file:
+                entry = cPickle.load(cache_file)
+        except (IOError, EOFError, ValueError, cPickle.UnpicklingError):
+            return None
+        if entry['environment'] != self.environment():
+            return None
+        if any(os.environ.get(name) != value for name, value in entry.get('variables', {}).items()):
+            return None
+        if not all(self.unchanged(path, fingerprint) for path, fingerprint in entry['inputs'].items()):
+            return None
+        return entry
+
+    def put(self, key, inputs, compose, specs, variables):
+        """Stores the entry; `inputs` are the fingerprints of the files it was built from and `variables` the values of the
+        interpolated variables. Failures are ignored."""
+        entry = {'inputs': inputs, 'environment': self.environment(), 'compose': compose, 'specs': specs, 'variables': variables}
+        path = os.path.join(self.directory, key)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(path + '.tmp', 'wb') as cache_file:
+                cPickle.dump(entry, cache_file, cPickle.HIGHEST_PROTOCOL)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError) as e:
+            print >> sys.stderr, ('WARNING: can not write cache {}: {}'.format(path, e))
+
+def compile_template(text):
+    """Parses `text` into a tuple of literal strings and `(name, operator, argument)` variable references."""
+    parts = []
+    position = 0
+    for match in VARIABLE_PATTERN.finditer(text):
+        if match.group('invalid') is not None:
+            raise ComposeError('invalid interpolation format in "{}"'.format(text))
+        parts.append(text[position:match.start()])
+        if match.group('escaped'):
+            parts.append('$')
+        else:
+            parts.append((match.group('named') or match.group('braced'), match.group('operator'), match.group('argument') or ''))
+        position = match.end()
+    parts.append(text[position:])
+
+    result = []
+    for part in parts:
+        if isinstance(part, basestring) and result and isinstance(result[-1], basestring):
+            result[-1] += part
+        elif part != '':
+            result.append(part)
+    return tuple(result)
+
+def escape_variables(value):
+    """Returns `value` with every `$` in its strings escaped as `$$`, for files that docker interpolates again."""
+    if isinstance(value, basestring):
+        return value.replace('$', '$$')
+    if isinstance(value, dict):
+        return type(value)((key, escape_variables(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [escape_variables(item) for item in value]
+    return value
+
+class Interpolator(object):
+    """Substitutes `$VAR`, `${VAR}`, `${VAR:-default}`, `${VAR-default}`, `${VAR:?error}` and `${VAR?error}` in the string
+    values of the model (`$$` is a literal `$`) with the values from `environ`.
+
+    Every distinct string is compiled once and its result is kept, so repeated values cost a dictionary lookup. The
+    variables that were referenced are recorded in `variables`.
+    """
+
+    def __init__(self, environ=None):
+        self.environ = os.environ if environ is None else environ
+        self.variables = set()
+        self._results = {}
+
+    def values(self):
+        return dict((name, self.environ.get(name)) for name in self.variables)
+
+    def value(self, name, operator, argument):
+        self.variables.add(name)
+        value = self.environ.get(name)
+        if value is not None and not (value == '' and operator and operator.startswith(':')):
+            return value
+        if operator in ('-', ':-'):
+            return argument
+        if operator in ('?', ':?'):
+            raise ComposeError('variable {} is not set: {}'.format(name, argument or 'it is required'))
+        print >> sys.stderr, ('WARNING: variable {} is not set, substituting an empty string'.format(name))
+        return ''
+
+    def substitute(self, text):
+        if '$' not in text:
+            return text
+        if text not in self._results:
+            self._results[text] = ''.join(part if isinstance(part, basestring) else self.value(*part) for part in compile_template(text))
+        return self._results[text]
+
+    def interpolate(self, value):
+        """Returns `value` with every string in it substituted; containers are copied, `value` is left as is."""
+        if isinstance(value, basestring):
+            return self.substitute(value)
+        if isinstance(value, dict):
+            return type(value)((key, self.interpolate(item)) for key, item in value.items())
+        if isinstance(value, list):
+            return [self.interpolate(item) for item in value]
+        return value
+
+class EnvFiles(object):
+    """Env files, each parsed once per run and shared read-only by every service that lists it."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._files = {}
+
+    def lines(self, path):
+        """Returns the `NAME=value` lines of the env file, without comments and blank lines."""
+        path = os.path.abspath(path)
+        with self.lock:
+            if path not in self._files:
+                with open(path) as env_file:
+                    self._files[path] = tuple(line.strip() for line in env_file if not line.startswith('#') and line.strip())
+            return self._files[path]
+
+    def invalidate(self, paths):
+        with self.lock:
+            for path in paths:
+                self._files.pop(os.path.abspath(path), None)
+
+class Journal(object):
+    """Append-only journal of the operations of a plan applied to a swarm, so that an interrupted `up` can be resumed.
+
+    Every line is a JSON record of an operation that was planned, done or failed. The journal is removed once the whole
+    plan was applied; without a `path` nothing is recorded.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def path_for(project, host, plan):
+        directory = os.path.join(os.environ.get('XDG_STATE_HOME') or os.path.expanduser('~/.local/state'), 'docker-compose-swarm-mode')
+        data = json.dumps([project, host, hashlib.sha1(json.dumps(plan, sort_keys=True)).hexdigest()])
+        return os.path.join(directory, hashlib.sha1(data).hexdigest() + '.journal')
+
+    def completed(self):
+        """Returns the keys of the operations recorded as done."""
+        result = set()
+        if not self.path or not os.path.isfile(self.path):
+            return result
+        with open(self.path) as journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # cut short by a crash
+                if record['event'] == 'done':
+                    result.add(record['key'])
+        return result
 
+    def start(self, keys, resume=False):
+        """Starts a journal of the planned `keys`, or continues the existing one with `resume`."""
+        if not self.path:
+            return
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        if not resume and os.path.isfile(self.path):
+            os.remove(self.path)
+        self.record('planned', None, keys=keys)
+
+    def record(self, event, key, **fields):
+        if not self.path:
+            return
+        record = OrderedDict([('time', time.time()), ('event', event), ('key', key)])
+        record.update(fields)
+        with self.lock:
+            with open(self.path, 'a') as journal_file:
+                journal_file.write(json.dumps(record) + '\n')
+
+    def finish(self):
+        if self.path and os.path.isfile(self.path):
+            os.remove(self.path)
+
+class FileWatcher(object):
+    """Waits for files to change.
+
+    On Linux the directories of the files are watched with inotify, so waiting costs nothing until something in them
+    changes; elsewhere, or if inotify is unavailable, the files are polled every `interval` seconds. Either way, a file
+    only counts as changed when its fingerprint changed.
+    """
+
+    IN_EVENTS = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200  # modify, attrib, close_write, moved_from/to, create, delete
+
+    def __init__(self, paths, interval=WATCH_INTERVAL):
+        self.interval = interval
+        self.paths = []
+        self.fingerprints = {}
+        self.directories = set()
+        self.fd = None
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = self.libc.inotify_init1(os.O_NONBLOCK | 0o2000000)  # IN_NONBLOCK | IN_CLOEXEC
+            self.fd = fd if fd >= 0 else None
+        except (OSError, AttributeError):
+            pass  # not Linux
+        self.watch(paths)
+
+    def watch(self, paths):
+        """Sets the files to watch; changes made before the call are not reported."""
+        self.paths = sorted(set(os.path.abspath(path) for path in paths))
+        self.fingerprints = ModelCache.fingerprints(self.paths)
+        for directory in set(os.path.dirname(path) for path in self.paths) - self.directories:
+            if self.fd is not None and self.libc.inotify_add_watch(self.fd, directory, self.IN_EVENTS) < 0:
+                os.close(self.fd)
+                self.fd = None  # fall back to polling
+            self.directories.add(directory)
+
+    def changed(self):
+        result = [path for path in self.paths if not ModelCache.unchanged(path, self.fingerprints[path])]
+        self.fingerprints.update(ModelCache.fingerprints(result))
         return result
 
+    def wait(self, timeout=None):
+        """Returns the files that changed, waiting up to `timeout` seconds (forever for None) for a change."""
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            remaining = max(deadline - time.time(), 0) if deadline is not None else None
+            if self.fd is not None:
+                if select.select([self.fd], [], [], remaining)[0]:
+                    try:
+                        while os.read(self.fd, 65536):
+                            pass
+                    except OSError:
+                        pass  # drained
+            else:
+                time.sleep(self.interval if remaining is None else min(self.interval, remaining))
+            changed = self.changed()
+            if changed or (deadline is not None and time.time() >= deadline):
+                return changed
+
+class ServiceSpec(object):
+    """`docker service create` arguments collected by the translators in SERVICE_TRANSLATORS."""
+
+    def __init__(self):
+        self.flags = []
+        self.image = None
+        self.command = []
+
+    def add_flag(self, key, value=None):
+        self.flags.append([key, value])
+
+def translate_ignored(compose, value, spec):  # pylint: disable=unused-argument
+    pass  # unsupported by `docker service` or only affects the order of creation
+
+def translate_restart(compose, value, spec):  # pylint: disable=unused-argument
+    spec.add_flag('--restart-condition', {'always': 'any'}[value])
+
+def translate_logging(compose, value, spec):  # pylint: disable=unused-argument
+    spec.add_flag('--log-driver', value.get('driver', 'json-file'))
+    log_opts = value['options']
+    if log_opts:
+        for key, item in log_opts.items():
+            if item is not None:
+                spec.add_flag('--log-opt', '{}={}'.format(key, item))
+
+def translate_mem_limit(compose, value, spec):  # pylint: disable=unused-argument
+    spec.add_flag('--limit-memory', value)
+
+def translate_image(compose, value, spec):  # pylint: disable=unused-argument
+    spec.image = value
+
+def translate_command(compose, value, spec):  # pylint: disable=unused-argument
+    if isinstance(value, list):
+        spec.command.extend(value)
+    else:
+        spec.command.extend(value.split(' '))
+
+def translate_hostname(compose, value, spec):  # pylint: disable=unused-argument
+    spec.add_flag('--hostname', value)
+
+#   --health-cmd string                Command to run to check health
+#   --health-interval duration         Time between running the check (ns|us|ms|s|m|h)
+#   --health-retries int               Consecutive failures needed to report unhealthy
+#   --health-timeout duration          Maximum time to allow one check to run (ns|us|ms|s|m|h)
+#   --no-healthcheck                   Disable any container-specified HEALTHCHECK
+def translate_healthcheck(compose, value, spec):  # pylint: disable=unused-argument
+    if 'disable' in value and value['disable']:
+        spec.add_flag('--no-healthcheck')
+        return
+    if 'test' in value:
+        test = deque(value['test'])
+        test_type = test.popleft()
+        if test:
+            if test_type == 'NONE':
+                spec.add_flag('--no-healthcheck')
+            if test_type == 'CMD':
+                spec.add_flag('--healthcheck-cmd', ' '.join(test))
+            if test_type == 'CMD-SHELL':
+                spec.add_flag('--healthcheck-cmd', ' '.join(test))
+    if 'interval' in value:
+        spec.add_flag('--health-interval', value['interval'])
+    if 'retries' in value:
+        spec.add_flag('--health-retries', value['retries'])
+    if 'timeout' in value:
+        spec.add_flag('--health-timeout', value['timeout'])
+
+def translate_labels(compose, value, spec):  # pylint: disable=unused-argument
+    if isinstance(value, dict):
+        value = ('%s=%s' % i for i in value.iteritems())
+
+    for label in value:
+        spec.add_flag('--label', label)
+
+# --mode string                      Service mode (replicated or global) (default "replicated")
+# --replicas uint                    Number of tasks
+# --constraint list                  Placement constraints (default [])
+# --restart-condition string         Restart when condition is met (none, on-failure, or any)
+# --restart-delay duration           Delay between restart attempts (ns|us|ms|s|m|h)
+# --restart-max-attempts uint        Maximum number of restarts before giving up
+# --restart-window duration          Window used to evaluate the restart policy (ns|us|ms|s|m|h)
+# --update-delay duration            Delay between updates (ns|us|ms|s|m|h) (default 0s)
+# --update-failure-action string     Action on update failure (pause|continue) (default "pause")
+# --update-max-failure-ratio float   Failure rate to tolerate during an update
+# --update-monitor duration          Duration after each task update to monitor for failure (ns|us|ms|s|m|h) (default 0s)
+# --update-parallelism uint          Maximum number of tasks updated simultaneously (0 to update all at once) (default 1)
+def translate_deploy(compose, value, spec):  # pylint: disable=unused-argument
+    if 'mode' in value:
+        spec.add_flag('--mode', value['mode'])
+    if 'replicas' in value:
+        spec.add_flag('--replicas', value['replicas'])
+    if 'placement' in value and 'constraints' in value['placement']:
+        constraints = value['placement']['constraints']
+        for constraint in constraints:
+            spec.add_flag('--constraint', constraint)
+    if 'restart_policy' in value:
+        restart_policy = value['restart_policy']
+        if 'condition' in restart_policy:
+            spec.add_flag('--restart-condition', restart_policy['condition'])
+        if 'delay' in restart_policy:
+            spec.add_flag('--restart-delay', restart_policy['delay'])
+        if 'max_attempts' in restart_policy:
+            spec.add_flag('--restart-max-attempts', restart_policy['max_attempts'])
+        if 'window' in restart_policy:
+            spec.add_flag('--restart-window', restart_policy['window'])
+    if 'update_config' in value:
+        update_config = value['update_config']
+        if 'delay' in update_config:
+            spec.add_flag('--update-delay', update_config['delay'])
+        if 'failure_action' in update_config:
+            spec.add_flag('--update-failure-action', update_config['failure_action'])
+        if 'max_failure_ratio' in update_config:
+            spec.add_flag('--update-max-failure-ratio', update_config['max_failure_ratio'])
+        if 'monitor' in update_config:
+            spec.add_flag('--update-monitor', update_config['monitor'])
+        if 'parallelism' in update_config:
+            spec.add_flag('--update-parallelism', update_config['parallelism'])
+
+# --host list                        Set one or more custom host-to-IP mappings (host:ip) (default [])
+def translate_extra_hosts(compose, value, spec):  # pylint: disable=unused-argument
+    for host in value:
+        spec.add_flag('--host', host)
+
+# --log-driver string                Logging driver for service
+def translate_log_driver(compose, value, spec):  # pylint: disable=unused-argument
+    spec.add_flag('--log-driver', value)
+
+def translate_ports(compose, value, spec):  # pylint: disable=unused-argument
+    for port in value:
+        spec.add_flag('--publish', port)
+
+def translate_networks(compose, value, spec):
+    for network in value:
+        spec.add_flag('--network', network if compose.is_external_network(network) else compose.project_prefix(network))
+
+def translate_volumes(compose, value, spec):
+    for volume in value:
+        splitted_volume = volume.split(':')
+        src = splitted_volume.pop(0)
+        dst = splitted_volume.pop(0)
+        readonly = 0
+        if splitted_volume and splitted_volume[0] == 'ro':
+            readonly = 1
+        if src.startswith('.'):
+            src = src.replace('.', compose.compose_base_dir, 1)
+
+        if src.startswith('/'):
+            spec.add_flag('--mount', 'type=bind,src={},dst={},readonly={}'.format(src, dst, readonly))
+        else:
+            spec.add_flag('--mount', 'src={},dst={},readonly={}'.format(compose.project_prefix(src), dst, readonly))
+
+def translate_environment(compose, value, spec):  # pylint: disable=unused-argument
+    if isinstance(value, dict):
+        for key, item in value.items():
+            spec.add_flag('--env', '{}={}'.format(key, item))
+    else:
+        for env in value:
+            if env.startswith('constraint') or env.startswith('affinity'):
+                constraint = env.split(':', 2)[1]
+                spec.add_flag('--constraint', constraint)
+            else:
+                spec.add_flag('--env', env)
+
+def translate_env_file(compose, value, spec):
+    for item in [value] if isinstance(value, basestring) else value:
+        for line in compose.env_files.lines(item):
+            spec.add_flag('--env', line)
+
+# Compose service keys and the functions that translate their values to `docker service create` arguments.
+SERVICE_TRANSLATORS = {
+    'command': translate_command,
+    'container_name': translate_ignored,
+    'depends_on': translate_ignored,
+    'deploy': translate_deploy,
+    'env_file': translate_env_file,
+    'environment': translate_environment,
+    'expose': translate_ignored,
+    'extra_hosts': translate_extra_hosts,
+    'healthcheck': translate_healthcheck,
+    'hostname': translate_hostname,
+    'image': translate_image,
+    'labels': translate_labels,
+    'log_driver': translate_log_driver,
+    'logging': translate_logging,
+    'mem_limit': translate_mem_limit,
+    'networks': translate_networks,
+    'ports': translate_ports,
+    'restart': translate_restart,
+    'volumes': translate_volumes,
+}
+
+def stack_deploy_config(config):
+    return config.setdefault('deploy', OrderedDict())
+
+def stack_copy(key):
+    """Returns a stack converter that copies the value to `key` as is."""
+    def convert(compose, value, config):  # pylint: disable=unused-argument
+        config[key] = value
+    return convert
+
+def stack_ignored(compose, value, config):  # pylint: disable=unused-argument
+    pass  # unsupported by `docker stack deploy` or only affects the order of creation
+
+def stack_restart(compose, value, config):  # pylint: disable=unused-argument
+    stack_deploy_config(config).setdefault('restart_policy', OrderedDict())['condition'] = {'always': 'any'}[value]
+
+def stack_mem_limit(compose, value, config):  # pylint: disable=unused-argument
+    stack_deploy_config(config).setdefault('resources', OrderedDict()).setdefault('limits', OrderedDict())['memory'] = value
+
+def stack_log_driver(compose, value, config):  # pylint: disable=unused-argument
+    config.setdefault('logging', OrderedDict())['driver'] = value
+
+def stack_labels(compose, value, config):  # pylint: disable=unused-argument
+    labels = stack_deploy_config(config).setdefault('labels', [])
+    labels.extend(('%s=%s' % i for i in value.iteritems()) if isinstance(value, dict) else value)
+
+def stack_deploy(compose, value, config):  # pylint: disable=unused-argument
+    config['deploy'] = merge(config.get('deploy', OrderedDict()), value, ['deploy'], lambda a, b, key: a.__setitem__(key, b[key]))
+
+def stack_volumes(compose, value, config):
+    volumes = config.setdefault('volumes', [])
+    for volume in value:
+        src, _, rest = volume.partition(':')
+        if src.startswith('.'):
+            src = os.path.normpath(src.replace('.', compose.compose_base_dir, 1))
+        volumes.append(src + _ + rest)
+
+def stack_environment(compose, value, config):  # pylint: disable=unused-argument
+    environment = config.setdefault('environment', [])
+    for env in (('{}={}'.format(*item) for item in value.items()) if isinstance(value, dict) else value):
+        if env.startswith('constraint') or env.startswith('affinity'):
+            placement = stack_deploy_config(config).setdefault('placement', OrderedDict())
+            placement.setdefault('constraints', []).append(env.split(':', 2)[1])
+        else:
+            environment.append(env)
+
+def stack_env_file(compose, value, config):
+    environment = config.setdefault('environment', [])
+    for item in [value] if isinstance(value, basestring) else value:
+        environment.extend(compose.env_files.lines(item))
+
+# Compose service keys and the functions that convert them to the keys of a version 3 stack file; the counterpart of
+# SERVICE_TRANSLATORS for `docker stack deploy`.
+STACK_CONVERTERS = {
+    'command': stack_copy('command'),
+    'container_name': stack_ignored,
+    'depends_on': stack_ignored,
+    'deploy': stack_deploy,
+    'env_file': stack_env_file,
+    'environment': stack_environment,
+    'expose': stack_ignored,
+    'extra_hosts': stack_copy('extra_hosts'),
+    'healthcheck': stack_copy('healthcheck'),
+    'hostname': stack_copy('hostname'),
+    'image': stack_copy('image'),
+    'labels': stack_labels,
+    'log_driver': stack_log_driver,
+    'logging': stack_copy('logging'),
+    'mem_limit': stack_mem_limit,
+    'networks': stack_copy('networks'),
+    'ports': stack_copy('ports'),
+    'restart': stack_restart,
+    'volumes': stack_volumes,
+}
+
+class DockerCompose(object):
+    def __init__(self, compose, project, compose_base_dir, requested_services, refresh=False, backend='cli', executor=None, loader=None,
+                 specs=None, host=None, interpolator=None, dotenv=()):
+        self.project = project
+        self.compose_base_dir = compose_base_dir
+        self.loader = loader or ComposeLoader()
+        self.interpolator = interpolator or Interpolator()
+        self.dotenv = dotenv
+        self.env_files = EnvFiles()
+        self.load_model(compose)
+        self.requested_services = requested_services
+        self.filtered_services = [service for service in self.services if not requested_services or service in requested_services]
+        self.backend_type = backend
+        self.refresh = refresh
+        self.connect(host, executor or Executor())
+        self._service_specs = dict(specs or {})
+        self._unapplied = set()
+
+    def connect(self, host, executor):
+        """Points the instance to the swarm managed at `host` (None for the default one) with a fresh state snapshot."""
+        self.host = host
+        self.executor = executor
+        self.backend = ApiBackend(host, self.executor) if self.backend_type == 'api' else CliBackend(self.call, host, self.executor.lines)
+        self.state = ClusterState(self.backend)
+
+    def target(self, host, executor):
+        """Returns a copy of the instance for the swarm managed at `host`; the model and the translated specs are shared."""
+        target = copy.copy(self)
+        target.connect(host, executor)
+        return target
+
+    def translate(self):
+        """Translates every selected service that has an image, so that copies made by `target()` don't repeat it."""
+        for service in self.filtered_services:
+            if 'image' in self.services[service]:
+                self.service_spec(service)
+
+    def load_model(self, compose):
+        """Resolves `extends` of the merged compose files and interpolates the variables in a single pass over the result."""
+        self._model = OrderedDict([('services', self.merge_services(compose.get('services', {}))),
+                                   ('networks', compose.get('networks', {})), ('volumes', compose.get('volumes', {}))])
+        model = self.interpolator.interpolate(self._model)
+        self.services, self.networks, self.volumes = model['services'], model['networks'], model['volumes']
+
+    def model(self):
+        """Returns the model before interpolation."""
+        return self._model
+
+    def input_files(self):
+        """Returns the files, besides the compose files, the model and the service specs are built from."""
+        paths = [os.path.join(os.getcwd(), '.env')]
+        for service_config in self.services.values():
+            env_files = service_config.get('env_file') or []
+            paths.extend(os.path.abspath(path) for path in ([env_files] if isinstance(env_files, basestring) else env_files))
+        return paths
+
+    def project_prefix(self, value):
+        return '{}_{}'.format(self.project, value) if self.project else value
+
+    def merge_services(self, services):
+        return self.loader.resolve_services(services, self.compose_base_dir)
+
     @staticmethod
     def merge_env(obj1, obj2, key):
         if key == 'environment':
             if isinstance(obj1[key], dict) and isinstance(obj2[key], list):
                 obj1[key] = obj2[key] + list({'{}={}'.format(k, v) for k, v in obj1[key].items()})
             elif isinstance(obj1[key], list) and isinstance(obj2[key], dict):
-                obj1[key][:0] = list({'{}={}'.format(k, v) for k, v in obj2[key].items()})
+                obj1[key] = list({'{}={}'.format(k, v) for k, v in obj2[key].items()}) + obj1[key]
             else:
                 raise 'Unknown type of "{}" value (should be either list or dictionary)'.format(key)
 
-    @staticmethod
-    def call(cmd, ignore_return_code=False):
-        print 'Running: \n' + cmd + '\n'
-        if not DEBUG:
-            proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            returncode = proc.wait()
-            stdout = proc.communicate()[0]
-            if returncode != 0 and not ignore_return_code:
-                print >> sys.stderr, ('Error: command "{}" failed: {}'.format(cmd, stdout))
-                sys.exit(returncode)
-            else:
-                return stdout
+    def call(self, cmd, ignore_return_code=False, stream=False):
+        return self.executor.run(cmd, ignore_return_code, stream)
 
     def is_service_exists(self, service):
-        return self.call('/bin/bash -o pipefail -c "docker service ls | awk \'{{print \\$2}}\' | (egrep \'^{}$\' || :)"'.format(self.project_prefix(service)))
+        return self.state.exists('service', self.project_prefix(service))
 
     def is_external_network(self, network):
         if network not in self.networks:
-            print >> sys.stderr, ('Error: network "{}" is not defined in networks'.format(network))
-            sys.exit(1)
+            raise ComposeError('network "{}" is not defined in networks'.format(network))
         return isinstance(self.networks[network], dict) and 'external' in self.networks[network]
 
-    def create_networks(self):
-        for network in self.networks:
-            if not self.is_external_network(network):
-                cmd = '[ "`docker network ls | awk \'{{print $2}}\' | egrep \'^{0}$\'`" != "" ] || docker network create --driver overlay --opt encrypted {0}' \
-                    .format(self.project_prefix(network))
-                self.call(cmd)
-
-    def create_volumes(self):
-        for volume in self.volumes:
-            cmd = '[ "`docker volume ls | awk \'{{print $2}}\' | egrep \'^{0}$\'`" != "" ] || docker volume create --name {0}' \
-                .format(self.project_prefix(volume))
-            if isinstance(self.volumes[volume], dict) and self.volumes[volume]['driver']:
-                cmd = cmd + ' --driver={0}'.format(self.volumes[volume]['driver'])
-            for opt in self.volumes[volume]['driver_opts']:
-                cmd = cmd + ' \\\n --opt {}={}'.format(opt, self.volumes[volume]['driver_opts'][opt])
-            self.call(cmd)
-
-    def service_create(self, service):
-        service_config = self.services[service]
-        cmd = ['docker service create --with-registry-auth \\\n --name', self.project_prefix(service), '\\\n']
-
-        service_image = []
-        service_command = []
-
-        def add_flag(key, value=None):
-            if value is None:
-                cmd.extend([key, '\\\n'])
-            elif isinstance(value, int):
-                cmd.extend([key, str(value), '\\\n'])
+    def network_create(self, operation):
+        with TRACER.span(operation['id'], 'network', operation='create'):
+            self.backend.create_network(operation['name'], operation['driver'], operation['options'])
+        self.state.added('network', operation['name'])
+
+    def volume_create(self, operation):
+        with TRACER.span(operation['id'], 'volume', operation='create'):
+            self.backend.create_volume(operation['name'], operation['driver'], operation['options'])
+        self.state.added('volume', operation['name'])
+
+    def service_spec(self, service):
+        """Translates the service config to `docker service create` arguments.
+
+        Returns `(flags, image, command)` where `flags` is a list of `[flag, value]` pairs (`value` is None for flags
+        without a value).
+        """
+        if service in self._service_specs:
+            return self._service_specs[service]
+
+        spec = ServiceSpec()
+        for parameter, value in self.services[service].items():
+            translator = SERVICE_TRANSLATORS.get(parameter)
+            if translator is None:
+                OUTPUT.write('WARNING: unsupported parameter {}'.format(parameter), sys.stderr)
             else:
-                cmd.extend([key, shellquote(value), '\\\n'])
-
-        value = ''
-
-        for parameter in service_config:
-            value = service_config[parameter]
-
-            def restart():  # pylint: disable=unused-variable
-                add_flag('--restart-condition', {'always': 'any'}[value])
+                translator(self, value, spec)
+
+        if spec.image is None:
+            raise ComposeError('no image specified for %s service' % service)
+
+        self._service_specs[service] = (spec.flags, spec.image, spec.command)
+        return self._service_specs[service]
+
+    def service_labels(self, service):
+        """Returns the labels that record the translated spec on the created service."""
+        spec = self.service_spec(service)
+        data = json.dumps(spec, sort_keys=True, separators=(',', ':'))
+        return OrderedDict([(SPEC_HASH_LABEL, hashlib.sha1(data).hexdigest()), (SPEC_LABEL, data)])
+
+    def service_create(self, operation):
+        label_flags = [['--label', '{}={}'.format(*label)] for label in operation['labels'].items()]
+        with TRACER.span(operation['id'], 'service', operation='create'):
+            self.backend.create_service(operation['name'], operation['flags'] + label_flags, operation['image'], operation['command'])
+        self.state.added('service', operation['name'])
+        self.state.changed(operation['name'])
+
+    def service_update(self, operation, spec):
+        """Applies the changes between the existing service and the operation.
+
+        The old flags are the ones recorded in the labels of the service `spec`; services created without them are
+        compared with flags rebuilt from the `spec` itself.
+        """
+        flags, image, command = operation['flags'], operation['image'], operation['command']
+        labels = spec.get('Labels') or {}
+        if SPEC_LABEL in labels:
+            old_flags, old_image, old_command = json.loads(labels[SPEC_LABEL])
+        else:
+            old_flags, old_image, old_command = service_flags_from_spec(spec, self.state.network_names())
+
+        update_flags = spec_update_flags(old_flags, flags)
+        if image != old_image:
+            update_flags.append(['--image', image])
+        if command != old_command:
+            update_flags.append(['--args', ' '.join(pipes.quote(arg) for arg in command)])
+        labels = operation['labels'].items()
+        update_flags.extend(['--label-add', '{}={}'.format(*label)] for label in labels)
+
+        with TRACER.span(operation['id'], 'service', operation='update'):
+            self.backend.update_service(operation['name'], update_flags, flags + [['--label', '{}={}'.format(*label)] for label in labels],
+                                        image, command)
+        self.state.changed(operation['name'])
+
+    def service_dependencies(self, service):
+        """Returns the networks, volumes and services (as `(kind, name)` pairs) that must exist before the service is created."""
+        service_config = self.services[service]
+        result = [('network', network) for network in service_config.get('networks', [])]
+        for volume in service_config.get('volumes', []):
+            src = volume.split(':')[0]
+            if src in self.volumes:
+                result.append(('volume', src))
+        result.extend(('service', dependency) for dependency in service_config.get('depends_on', []))
+        return result
 
-            def logging():  # pylint: disable=unused-variable
-                add_flag('--log-driver', value.get('driver', 'json-file'))
-                log_opts = value['options']
-                if log_opts:
-                    for key, item in log_opts.items():
-                        if item is not None:
-                            add_flag('--log-opt', '{}={}'.format(key, item))
+    def compile_plan(self, services=None):
+        """Compiles the model into a plan: the networks, volumes and services to create, in the order they can be created.
 
-            def mem_limit():  # pylint: disable=unused-variable
-                add_flag('--limit-memory', value)
+        The plan only depends on the compose files, not on the state of the swarm, so it can be compiled once and then
+        applied to any number of swarms with `apply`. Only the given `services` are included (default: the selected ones),
+        networks and volumes always are. It is a JSON-serializable mapping with the `project` and the list of
+        `operations`; each operation has an `id` (`kind:name` within the compose file), a `kind`, the `name` of the object in
+        the swarm, the ids of the operations it `depends_on` and the arguments to create the object with.
+        """
+        operations = []
+        for network in self.networks:
+            if not self.is_external_network(network):
+                operations.append(OrderedDict([('id', 'network:' + network), ('kind', 'network'), ('name', self.project_prefix(network)),
+                                               ('depends_on', []), ('driver', 'overlay'), ('options', OrderedDict([('encrypted', None)]))]))
+        for volume in self.volumes:
+            volume_config = self.volumes[volume] if isinstance(self.volumes[volume], dict) else {}
+            operations.append(OrderedDict([('id', 'volume:' + volume), ('kind', 'volume'), ('name', self.project_prefix(volume)),
+                                           ('depends_on', []), ('driver', volume_config.get('driver')),
+                                           ('options', volume_config.get('driver_opts') or OrderedDict())]))
 
-            def image():  # pylint: disable=unused-variable
-                service_image.append(value)
+        services = self.filtered_services if services is None else services
+        ids = set(operation['id'] for operation in operations) | set('service:' + service for service in services)
+        for service in services:
+            flags, image, command = self.service_spec(service)
+            dependencies = ['{}:{}'.format(*dependency) for dependency in self.service_dependencies(service)]
+            operations.append(OrderedDict([('id', 'service:' + service), ('kind', 'service'), ('name', self.project_prefix(service)),
+                                           ('depends_on', [dependency for dependency in dependencies if dependency in ids]),
+                                           ('flags', flags), ('image', image), ('command', command),
+                                           ('labels', self.service_labels(service)), ('replicas', self.service_replicas(service))]))
+
+        dependencies = OrderedDict((operation['id'], operation['depends_on']) for operation in operations)
+        order = dict((key, index) for index, key in enumerate(topological_sort(dependencies)))
+        operations.sort(key=lambda operation: order[operation['id']])
+        return OrderedDict([('version', PLAN_VERSION), ('project', self.project), ('operations', operations)])
+
+    def plan(self, output=None):
+        """Writes the compiled plan as JSON to `output`, or to stdout."""
+        data = json.dumps(self.compile_plan(), indent=2, separators=(',', ': '))
+        if output:
+            with open(output, 'w') as plan_file:
+                plan_file.write(data + '\n')
+        else:
+            print data
+
+    def apply(self, plan, parallel=1, wait=False, wait_timeout=300, resume=False, retries=0, retry_backoff=1):
+        """Creates the objects of the plan that do not exist yet, updates the services whose spec changed and scales the
+        existing services to their replicas. With `wait`, then waits for the services to converge.
+
+        Progress is kept in a Journal; with `resume` the operations a previous run of the same plan completed are skipped.
+        A failed operation is retried up to `retries` times, waiting `retry_backoff` seconds and twice as long every next
+        time, while independent operations go on.
+        """
+        if plan.get('version') != PLAN_VERSION:
+            raise ComposeError('unsupported plan version {} (expected {})'.format(plan.get('version'), PLAN_VERSION))
+
+        operations = OrderedDict((operation['id'], operation) for operation in plan['operations'])
+        journal = Journal(None if DEBUG else Journal.path_for(self.project, self.host, plan))
+        done = journal.completed() if resume else set()
+        if done:
+            OUTPUT.write('Resuming: {} of {} operations are done already'.format(len(done & set(operations)), len(operations)))
+        journal.start(list(operations) + ['scale'], resume)
+
+        services = [operation['name'] for key, operation in operations.items() if operation['kind'] == 'service' and key not in done]
+        specs = self.state.specs(services)
+
+        jobs = OrderedDict()
+        services_to_start = OrderedDict()
+        for key, operation in operations.items():
+            if key in done:
+                if operation['kind'] == 'service' and operation['replicas'] is not None:
+                    services_to_start[operation['name']] = operation['replicas']
+                continue
+            if operation['kind'] == 'network' and not self.state.exists('network', operation['name']):
+                jobs[key] = functools.partial(self.network_create, operation)
+            elif operation['kind'] == 'volume' and not self.state.exists('volume', operation['name']):
+                jobs[key] = functools.partial(self.volume_create, operation)
+            elif operation['kind'] == 'service':
+                if not self.state.exists('service', operation['name']):
+                    jobs[key] = functools.partial(self.service_create, operation)
+                    continue
+                if operation['replicas'] is not None:
+                    services_to_start[operation['name']] = operation['replicas']
+                spec = specs.get(operation['name'], {})
+                if (spec.get('Labels') or {}).get(SPEC_HASH_LABEL) != operation['labels'][SPEC_HASH_LABEL]:
+                    jobs[key] = functools.partial(self.service_update, operation, spec)
+            if key not in jobs:
+                journal.record('done', key)
+
+        def run(key, job):
+            for attempt in range(retries + 1):
+                try:
+                    if attempt:
+                        job = self.retry_job(operations[key], job)
+                    if job:
+                        job()
+                    break
+                except CommandError as e:
+                    if attempt == retries:
+                        journal.record('failed', key, error=str(e))
+                        raise
+                    delay = retry_backoff * 2 ** attempt
+                    OUTPUT.write('WARNING: {} failed, retrying in {:.1f}s: {}'.format(key, delay, str(e).strip()), sys.stderr)
+                    time.sleep(delay)
+            journal.record('done', key)
+
+        errors = run_parallel(OrderedDict((key, functools.partial(run, key, job)) for key, job in jobs.items()),
+                              dict((key, operations[key]['depends_on']) for key in jobs), parallel, lambda key: key.split(':', 1)[1],
+                              keep_going=True)
+        for key, error in errors.items():
+            OUTPUT.write('Error: {} "{}": {}'.format(operations[key]['kind'], key.split(':', 1)[1], error), sys.stderr)
+        if errors:
+            if journal.path:
+                OUTPUT.write('Run again with --resume to continue with the remaining operations', sys.stderr)
+            raise OperationsError(errors)
+
+        if services_to_start and 'scale' not in done:
+            self.backend.scale(services_to_start)
+        journal.record('done', 'scale')
+        journal.finish()
+
+        if wait:
+            self.wait_services(OrderedDict((operation['name'], operation['replicas']) for operation in operations.values()
+                                           if operation['kind'] == 'service'), wait_timeout)
+
+    def retry_job(self, operation, job):
+        """Returns the job to retry the operation with, after checking what the failed attempt left in the swarm."""
+        if operation['name'] not in self.backend.list(operation['kind']):
+            return job
+        self.state.added(operation['kind'], operation['name'])
+        if operation['kind'] != 'service':
+            return None  # created after all
+        spec = (self.backend.inspect_services([operation['name']]) or [{}])[0]
+        if (spec.get('Labels') or {}).get(SPEC_HASH_LABEL) == operation['labels'][SPEC_HASH_LABEL]:
+            return None
+        return functools.partial(self.service_update, operation, spec)
+
+    def service_up(self, parallel=1, wait=False, wait_timeout=300, stack=False, resume=False, retries=0, retry_backoff=1):
+        if stack:
+            self.stack_deploy(wait, wait_timeout)
+        else:
+            self.apply(self.compile_plan(), parallel, wait, wait_timeout, resume, retries, retry_backoff)
 
-            def command():  # pylint: disable=unused-variable
-                if isinstance(value, list):
-                    service_command.extend(value)
-                else:
-                    service_command.extend(value.split(' '))
-
-            def expose():  # pylint: disable=unused-variable
-                pass  # unsupported
-
-            def container_name():  # pylint: disable=unused-variable
-                pass  # unsupported
-
-            def hostname():  # pylint: disable=unused-variable
-                add_flag('--hostname', value)
-
-            #   --health-cmd string                Command to run to check health
-            #   --health-interval duration         Time between running the check (ns|us|ms|s|m|h)
-            #   --health-retries int               Consecutive failures needed to report unhealthy
-            #   --health-timeout duration          Maximum time to allow one check to run (ns|us|ms|s|m|h)
-            #   --no-healthcheck                   Disable any container-specified HEALTHCHECK
-            def healthcheck():  # pylint: disable=unused-variable
-                if 'disable' in value and value['disable']:
-                    add_flag('--no-healthcheck')
-                    return
-                if 'test' in value:
-                    test = deque(value['test'])
-                    test_type = test.popleft()
-                    print test
-                    print test_type
-                    if test:
-                        if test_type == 'NONE':
-                            add_flag('--no-healthcheck')
-                        if test_type == 'CMD':
-                            add_flag('--healthcheck-cmd', ' '.join(test))
-                        if test_type == 'CMD-SHELL':
-                            add_flag('--healthcheck-cmd', ' '.join(test))
-                if 'interval' in value:
-                    add_flag('--health-interval', value['interval'])
-                if 'retries' in value:
-                    add_flag('--health-retries', value['retries'])
-                if 'timeout' in value:
-                    add_flag('--health-timeout', value['timeout'])
-
-            def labels():  # pylint: disable=unused-variable
-                value = service_config[parameter]
-                # ^ working-around the lack of `nonlocal` statement.
-                if isinstance(value, dict):
-                    value = ('%s=%s' % i for i in value.iteritems())
-
-                for label in value:
-                    add_flag('--label', label)
-
-            # --mode string                      Service mode (replicated or global) (default "replicated")
-            # --replicas uint                    Number of tasks
-            # --constraint list                  Placement constraints (default [])
-            # --restart-condition string         Restart when condition is met (none, on-failure, or any)
-            # --restart-delay duration           Delay between restart attempts (ns|us|ms|s|m|h)
-            # --restart-max-attempts uint        Maximum number of restarts before giving up
-            # --restart-window duration          Window used to evaluate the restart policy (ns|us|ms|s|m|h)
-            # --update-delay duration            Delay between updates (ns|us|ms|s|m|h) (default 0s)
-            # --update-failure-action string     Action on update failure (pause|continue) (default "pause")
-            # --update-max-failure-ratio float   Failure rate to tolerate during an update
-            # --update-monitor duration          Duration after each task update to monitor for failure (ns|us|ms|s|m|h) (default 0s)
-            # --update-parallelism uint          Maximum number of tasks updated simultaneously (0 to update all at once) (default 1)
-            def deploy():  # pylint: disable=unused-variable
-                if 'mode' in value:
-                    add_flag('--mode', value['mode'])
-                if 'replicas' in value:
-                    add_flag('--replicas', value['replicas'])
-                if 'placement' in value and 'constraints' in value['placement']:
-                    constraints = value['placement']['constraints']
-                    for constraint in constraints:
-                        add_flag('--constraint', constraint)
-                if 'restart_policy' in value:
-                    restart_policy = value['restart_policy']
-                    if 'condition' in restart_policy:
-                        add_flag('--restart-condition', restart_policy['condition'])
-                    if 'delay' in restart_policy:
-                        add_flag('--restart-delay', restart_policy['delay'])
-                    if 'max_attempts' in restart_policy:
-                        add_flag('--restart-max-attempts', restart_policy['max_attempts'])
-                    if 'window' in restart_policy:
-                        add_flag('--restart-window', restart_policy['window'])
-                if 'update_config' in value:
-                    update_config = value['update_config']
-                    if 'delay' in update_config:
-                        add_flag('--update-delay', update_config['delay'])
-                    if 'failure_action' in update_config:
-                        add_flag('--update-failure-action', update_config['failure_action'])
-                    if 'max_failure_ratio' in update_config:
-                        add_flag('--update-max-failure-ratio', update_config['max_failure_ratio'])
-                    if 'monitor' in update_config:
-                        add_flag('--update-monitor', update_config['monitor'])
-                    if 'parallelism' in update_config:
-                        add_flag('--update-parallelism', update_config['parallelism'])
-
-            # --host list                        Set one or more custom host-to-IP mappings (host:ip) (default [])
-            def extra_hosts():  # pylint: disable=unused-variable
-                for host in value:
-                    add_flag('--host', host)
-
-            # --log-driver string                Logging driver for service
-            def log_driver():  # pylint: disable=unused-variable
-                add_flag('--log-driver', value)
-
-            def ports():  # pylint: disable=unused-variable
-                for port in value:
-                    add_flag('--publish', port)
-
-            def networks():  # pylint: disable=unused-variable
-                for network in value:
-                    add_flag('--network', network if self.is_external_network(network) else self.project_prefix(network))
-
-            def volumes():  # pylint: disable=unused-variable
-                for volume in value:
-                    splitted_volume = volume.split(':')
-                    src = splitted_volume.pop(0)
-                    dst = splitted_volume.pop(0)
-                    readonly = 0
-                    if splitted_volume and splitted_volume[0] == 'ro':
-                        readonly = 1
-                    if src.startswith('.'):
-                        src = src.replace('.', self.compose_base_dir, 1)
-
-                    if src.startswith('/'):
-                        add_flag('--mount', 'type=bind,src={},dst={},readonly={}'.format(src, dst, readonly))
-                    else:
-                        add_flag('--mount', 'src={},dst={},readonly={}'.format(self.project_prefix(src), dst, readonly))
-
-            def environment():  # pylint: disable=unused-variable
-                if isinstance(value, dict):
-                    for key, item in value.items():
-                        add_flag('--env', '{}={}'.format(key, item))
+    def watch(self, files, parallel=1, debounce=WATCH_DEBOUNCE):
+        """Brings the selected services up and then keeps them in sync with the compose `files`, the files they extend and
+        the env files until interrupted. Bursts of changes are collected until `debounce` seconds pass without one, then
+        only the affected services are applied, together with whatever failed to apply before."""
+        try:
+            self.apply_services(None, parallel)
+        except (ComposeError, CommandError) as e:
+            print >> sys.stderr, ('Error: {}'.format(e))
+        if not self.loader.paths():
+            # The model came from the cache, so load the files once to find the files they extend.
+            self.merge_services(reduce(merge, [self.loader.load(path) for path in files]).get('services', {}))
+        watcher = FileWatcher(self.watched_files(files))
+        OUTPUT.write('Watching {} files for changes'.format(len(watcher.paths)))
+        try:
+            while True:
+                changed = set(watcher.wait())
+                more = watcher.wait(debounce)
+                while more:
+                    changed.update(more)
+                    more = watcher.wait(debounce)
+                try:
+                    self.reconcile(files, changed, parallel)
+                except (ComposeError, CommandError, yaml.YAMLError, IOError) as e:
+                    print >> sys.stderr, ('Error: {}'.format(e))
+                watcher.watch(self.watched_files(files))
+        except KeyboardInterrupt:
+            return
+
+    def apply_services(self, services, parallel):
+        """Applies the plan of `services` (default: the selected ones), remembering the operations that failed or were
+        skipped, so the next pass of `watch` applies them again."""
+        try:
+            self.apply(self.compile_plan(services), parallel)
+        except OperationsError as e:
+            self._unapplied = set(e.errors)
+            raise
+        self._unapplied = set()
+
+    def watched_files(self, files):
+        return [os.path.abspath(path) for path in files] + list(self.loader.paths()) + self.input_files()
+
+    def reconcile(self, files, changed, parallel=1):
+        """Reloads the model (and `.env`) after the `changed` files changed and applies the services whose config, env
+        files, networks or volumes changed, or whose last apply failed. The cluster state and the specs of the other services are kept, unless `refresh`
+        is set."""
+        self.loader.invalidate(changed)
+        self.env_files.invalidate(changed)
+        if self.refresh:
+            self.state.reload()
+        dotenv_path = os.path.join(os.getcwd(), '.env')
+        if dotenv_path in changed:
+            self.dotenv = load_dotenv(dotenv_path, self.dotenv)
+            self.interpolator = Interpolator()
+        previous = self.services
+        previous_networks, previous_volumes = self.networks, self.volumes
+        self.load_model(reduce(merge, [self.loader.load(path) for path in files]))
+        services, networks, volumes = self.services, self.networks, self.volumes
+
+        changed_objects = set(('network', network) for network in set(networks) | set(previous_networks)
+                              if networks.get(network) != previous_networks.get(network))
+        changed_objects.update(('volume', volume) for volume in set(volumes) | set(previous_volumes)
+                               if volumes.get(volume) != previous_volumes.get(volume))
+        self.filtered_services = [service for service in services if not self.requested_services or service in self.requested_services]
+
+        affected = []
+        for service in self.filtered_services:
+            env_files = services[service].get('env_file') or []
+            env_files = [os.path.abspath(path) for path in ([env_files] if isinstance(env_files, basestring) else env_files)]
+            if ('service:' + service in self._unapplied or
+                    services[service] != previous.get(service) or
+                    any(path in changed for path in env_files) or
+                    any(dependency in changed_objects for dependency in self.service_dependencies(service))):
+                affected.append(service)
+                self._service_specs.pop(service, None)
+
+        if not affected and not changed_objects and not self._unapplied:
+            OUTPUT.write('No service changed')
+            return
+        OUTPUT.write('Applying {}'.format(', '.join(affected) if affected else 'networks and volumes'))
+        self.apply_services(affected, parallel)
+
+    def stack_config(self):
+        """Converts the model to a version 3 stack file to deploy with the project as the stack name.
+
+        The stack namespace prefixes services, networks and volumes the same way `project_prefix` does. Relative bind
+        mount sources are made absolute and env files are inlined, so the file can be deployed from anywhere. The values
+        are already interpolated, so `$` is escaped for `docker stack deploy`.
+        """
+        services = OrderedDict()
+        for service in self.filtered_services:
+            config = services[service] = OrderedDict()
+            for parameter, value in self.services[service].items():
+                converter = STACK_CONVERTERS.get(parameter)
+                if converter is None:
+                    OUTPUT.write('WARNING: unsupported parameter {}'.format(parameter), sys.stderr)
                 else:
-                    for env in value:
-                        if env.startswith('constraint') or env.startswith('affinity'):
-                            constraint = env.split(':', 2)[1]
-                            add_flag('--constraint', constraint)
-                        else:
-                            add_flag('--env', env)
-
-            def env_file():  # pylint: disable=unused-variable
-                for item in value:
-                    with open(item) as env_file:
-                        for line in env_file:
-                            if not line.startswith('#') and line.strip():
-                                add_flag('--env', line.strip())
-
-
-            def unsupported():
-                print >> sys.stderr, ('WARNING: unsupported parameter {}'.format(parameter))
-
-            locals().get(parameter, unsupported)()
-
-        if not service_image:
-            print 'ERROR: no image specified for %s service' % service
-            sys.exit(1)
-
-        cmd.extend(service_image)
-        cmd.extend(service_command)
-
-        self.call(' '.join(cmd))
-
-    def service_up(self):
-        self.create_networks()
-        self.create_volumes()
-
-        services_to_start = []
-
+                    converter(self, value, config)
+            if 'image' not in config:
+                raise ComposeError('no image specified for %s service' % service)
+
+        networks = OrderedDict()
+        for network, network_config in self.networks.items():
+            if self.is_external_network(network):
+                networks[network] = network_config
+            else:
+                networks[network] = OrderedDict([('driver', 'overlay'), ('driver_opts', OrderedDict([('encrypted', '')]))])
+
+        volumes = OrderedDict()
+        for volume, volume_config in self.volumes.items():
+            volume_config = volume_config if isinstance(volume_config, dict) else {}
+            volumes[volume] = OrderedDict((key, volume_config[key]) for key in ('driver', 'driver_opts') if volume_config.get(key))
+
+        result = OrderedDict([('version', '3'), ('services', services)])
+        if networks:
+            result['networks'] = networks
+        if volumes:
+            result['volumes'] = volumes
+        return escape_variables(result)
+
+    def convert(self, output=None):
+        """Writes the model as a version 3 stack file to `output`, or to stdout."""
+        data = '# docker stack deploy --compose-file FILE {}\n'.format(self.project)
+        data += yaml.dump(self.stack_config(), Dumper=OrderedDictDumper, default_flow_style=False, allow_unicode=True)
+        if output:
+            with open(output, 'w') as stack_file:
+                stack_file.write(data)
+        else:
+            sys.stdout.write(data)
+
+    def stack_deploy(self, wait=False, wait_timeout=300):
+        """Deploys the selected services with their networks and volumes as a single stack named after the project."""
+        if not self.project:
+            raise ComposeError('a project name is required to deploy a stack')
+        data = yaml.dump(self.stack_config(), Dumper=OrderedDictDumper, default_flow_style=False, allow_unicode=True)
+        with TRACER.span(self.project, 'stack', operation='deploy'):
+            self.backend.deploy_stack(self.project, data)
+        self.state.reload()
+        if wait:
+            self.wait(wait_timeout)
+
+    def pull_targets(self):
+        """Returns an ordered mapping of every image to the hostnames of the nodes its service tasks can be scheduled on."""
+        nodes = [(node['Description']['Hostname'], node_attributes(node)) for node in self.backend.nodes()
+                 if node['Status']['State'] == 'ready' and (node.get('Spec') or {}).get('Availability', 'active') != 'drain']
+
+        targets = OrderedDict()
         for service in self.filtered_services:
-            if self.is_service_exists(service):
-                services_to_start.append(service)
+            if 'image' not in self.services[service]:
                 continue
-
-            self.service_create(service)
-
-        if services_to_start:
-            self.service_start(services_to_start)
-
-    def pull(self):
-        nodes = self.call("docker node ls | grep Ready | awk -F'[[:space:]][[:space:]]+' '{print $2}'").rstrip().split('\n')
-
-        threads = []
-
-        for node in nodes:
-            cmd = '; '.join(['docker -H tcp://{}:2375 pull {}'.format(node, self.services[service]['image']) for service in self.filtered_services])
-            threads.append((node, threading.Thread(target=self.call, args=(cmd,))))
-
-        for node, thread in threads:
-            print 'Pulling on node {}'.format(node)
-            thread.start()
-
-        for node, thread in threads:
-            thread.join()
-            print 'Node {} - DONE'.format(node)
+            constraints = [value for flag, value in self.service_spec(service)[0] if flag == '--constraint']
+            eligible = [hostname for hostname, attributes in nodes if all(match_constraint(constraint, attributes) for constraint in constraints)]
+            if nodes and not eligible:
+                OUTPUT.write('WARNING: no node satisfies the constraints of {} service'.format(service), sys.stderr)
+            targets.setdefault(self.services[service]['image'], OrderedDict()).update(OrderedDict.fromkeys(eligible))
+        return OrderedDict((image, list(hostnames)) for image, hostnames in targets.items())
+
+    def pull(self, parallel=8, per_node=1):
+        scheduler = PullScheduler(self.backend, parallel, per_node)
+        scheduler.run(self.pull_targets())
+        scheduler.print_summary()
+        failed = sum(1 for result in scheduler.results if result['status'] == 'failed')
+        if failed:
+            raise ComposeError('{} of {} pulls failed'.format(failed, len(scheduler.results)))
 
     def service_stop(self):
         services = filter(self.is_service_exists, self.filtered_services)
-        cmd_args = ['{}={}'.format(self.project_prefix(service), 0) for service in services]
-        if cmd_args:
-            self.call('docker service scale ' + ' '.join(cmd_args))
+        if services:
+            self.backend.scale(OrderedDict((self.project_prefix(service), 0) for service in services))
 
     def service_remove(self):
         services = filter(self.is_service_exists, self.filtered_services)
-        cmd_args = [self.project_prefix(service) for service in services]
-        if cmd_args:
-            self.call('docker service rm ' + ' '.join(cmd_args))
+        names = [self.project_prefix(service) for service in services]
+        if names:
+            self.backend.remove_services(names)
+            for name in names:
+                self.state.removed('service', name)
 
-    def service_start(self, services=None):
+    def service_start(self, services=None, wait=False, wait_timeout=300):
         if services is None:
             services = self.filtered_services
 
-        cmd = 'docker service scale ' + \
-              ' '.join(['{}={}'.format(self.project_prefix(service), self.services[service].get('replicas', '1')) for service in services])
-        self.call(cmd)
+        replicated = [service for service in services if self.service_replicas(service) is not None]
+        if replicated:
+            self.backend.scale(OrderedDict((self.project_prefix(service), self.service_replicas(service)) for service in replicated))
+        if wait:
+            self.wait(wait_timeout, services)
+
+    def wait(self, wait_timeout=300, services=None):
+        """Waits for the existing services among `services` (default: the selected ones) to converge."""
+        if services is None:
+            services = self.filtered_services
+        self.wait_services(OrderedDict((self.project_prefix(service), self.service_replicas(service))
+                                       for service in services if self.is_service_exists(service)), wait_timeout)
+
+    def ps(self):
+        """Prints the tasks of the selected services, fetched with a single batched query."""
+        names = OrderedDict((self.project_prefix(service), service) for service in self.filtered_services if self.is_service_exists(service))
+        tasks = self.backend.tasks(list(names)) if names else {}
+        nodes = dict((node['ID'], node['Description']['Hostname']) for node in self.backend.nodes()) if any(tasks.values()) else {}
+
+        OUTPUT.write('{:<40} {:<20} {:<10} {:<10} {:<20} {}'.format('NAME', 'NODE', 'DESIRED', 'STATE', 'SINCE', 'ERROR'))
+        for name, service_tasks in tasks.items():
+            service_tasks = sorted(service_tasks, key=lambda task: task['Status'].get('Timestamp', ''), reverse=True)
+            for task in sorted(service_tasks, key=lambda task: task.get('Slot') or nodes.get(task.get('NodeID'), '')):
+                node = nodes.get(task.get('NodeID'), task.get('NodeID') or '')
+                OUTPUT.write('{:<40} {:<20} {:<10} {:<10} {:<20} {}'.format(
+                    '{}.{}'.format(names[name], task.get('Slot') or node), node, task.get('DesiredState', ''), task['Status']['State'],
+                    task['Status'].get('Timestamp', '')[:19].replace('T', ' '), task['Status'].get('Err') or ''))
+
+    def logs(self, follow=False, tail=None, timestamps=False):
+        """Prints the logs of the selected services as one stream ordered by time, prefixed with the service."""
+        streams = OrderedDict((service, self.backend.logs(self.project_prefix(service), follow, tail))
+                              for service in self.filtered_services if self.is_service_exists(service))
+        try:
+            errors = merge_logs(streams, timestamps)
+        except KeyboardInterrupt:
+            return
+        for service, error in errors.items():
+            OUTPUT.write('Error: logs of {}: {}'.format(service, error), sys.stderr)
+        if errors:
+            raise ComposeError('can not read the logs of {}'.format(', '.join(errors)))
+
+    def wait_services(self, replicas, timeout, interval=WAIT_INTERVAL):
+        """Waits until every service of `replicas` (an ordered mapping of service name to its replicas, None for global
+        services, which run a task on every eligible node and need at least one) runs all of its tasks.
+
+        The tasks of all services are fetched with one batched query per `interval`. Tasks of services with a healthcheck
+        only report running once it passes. Raises ComposeError when a current task is rejected, or any task is rejected
+        after the first poll, or when the services don't converge within `timeout` seconds.
+        """
+        if not replicas:
+            return
+        start = time.time()
+        rejected = None
+        reported = {}
+        while True:
+            tasks = self.backend.tasks(list(replicas))
+            if DEBUG:
+                return
+
+            pending = OrderedDict()
+            for name, count in replicas.items():
+                current = [task for task in tasks[name] if task.get('DesiredState') == 'running']
+                running = sum(1 for task in current if task['Status']['State'] == 'running')
+                # A global service has no tasks right after it is created; it needs at least one to converge.
+                desired = int(count) if count is not None else max(len(current), 1)
+                if running != desired or running != len(current):
+                    errors = [task['Status'].get('Err') or task['Status'].get('Message') for task in current if task['Status']['State'] != 'running']
+                    pending[name] = '{}/{} running{}'.format(running, desired, ': ' + errors[-1] if errors and errors[-1] else '')
+                if reported.get(name) != pending.get(name, 'converged'):
+                    reported[name] = pending.get(name, 'converged')
+                    OUTPUT.write('{}: {}'.format(name, reported[name]))
+
+            rejections = [(name, task) for name in replicas for task in tasks[name] if task['Status']['State'] == 'rejected']
+            if rejected is None:
+                rejected = set(task['ID'] for _, task in rejections if task.get('DesiredState') != 'running')
+            for name, task in rejections:
+                if task['ID'] not in rejected:
+                    raise ComposeError('task {} of {} was rejected: {}'.format(task['ID'][:12], name, task['Status'].get('Err')))
+
+            if not pending:
+                OUTPUT.write('{} services converged in {:.1f}s'.format(len(replicas), time.time() - start))
+                return
+            if time.time() - start >= timeout:
+                raise ComposeError('services did not converge within {:.0f}s: {}'.format(
+                    timeout, ', '.join('{} ({})'.format(*item) for item in pending.items())))
+            time.sleep(min(interval, max(timeout - (time.time() - start), 0)))
+
+    def service_replicas(self, service):
+        """Returns the number of replicas to scale the service to, or None for global services."""
+        deploy = self.services[service].get('deploy') or {}
+        if deploy.get('mode') == 'global':
+            return None
+        return deploy.get('replicas', self.services[service].get('replicas', '1'))
+
+def run_parallel(jobs, dependencies, parallel, label=None, keep_going=False):
+    """Runs `jobs` (an ordered mapping of key to callable), at most `parallel` at a time.
+
+    A job starts only after every job listed for it in `dependencies` has succeeded; dependencies that are not jobs
+    themselves are considered satisfied. Unless `keep_going` is set, no new jobs are started after the first failure.
+    Returns an ordered mapping of the keys of failed jobs to their exceptions; with `keep_going` the jobs that never ran
+    because a dependency failed are included with a SkippedError. When jobs run concurrently, their output is prefixed
+    with `label(key)`.
+    """
+    pending = OrderedDict((key, set(dependency for dependency in dependencies.get(key, []) if dependency in jobs)) for key in jobs)
+    topological_sort(pending)
+    results = Queue.Queue()
+    errors = OrderedDict()
+    running = 0
+
+    labels = OUTPUT.labels()
+
+    def worker(key):
+        try:
+            with OUTPUT.labeled(*(labels + ((label(key),) if label and parallel > 1 else ()))):
+                jobs[key]()
+            results.put((key, None))
+        except Exception as e:  # pylint: disable=broad-except
+            results.put((key, e))
+
+    while (pending and (keep_going or not errors)) or running:
+        ready = [key for key, waiting_for in pending.items() if not waiting_for]
+        while ready and running < max(parallel, 1) and (keep_going or not errors):
+            key = ready.pop(0)
+            del pending[key]
+            thread = threading.Thread(target=worker, args=(key,))
+            thread.daemon = True
+            thread.start()
+            running += 1
+
+        if not running:
+            break
+
+        # A timeout keeps the wait interruptible with Ctrl+C.
+        key, error = results.get(True, 365 * 24 * 3600)
+        running -= 1
+        if error is not None:
+            errors[key] = error
+        else:
+            for waiting_for in pending.values():
+                waiting_for.discard(key)
+
+    if keep_going:
+        # Whatever is still pending waits for a job that failed or was skipped itself.
+        for key in topological_sort(pending):
+            dependency = min(pending[key])
+            errors[key] = SkippedError(errors[dependency].dependency if isinstance(errors[dependency], SkippedError) else dependency)
+    return errors
+
+def group_tasks(names, tasks, service_names):
+    """Groups Engine API task objects by the name of their service (`service_names` maps service IDs to names)."""
+    result = OrderedDict((name, []) for name in names)
+    for task in tasks:
+        name = service_names.get(task.get('ServiceID'))
+        if name in result:
+            result[name].append(task)
+    return result
+
+def log_timestamp(timestamp):
+    """Pads the fraction of an RFC 3339 timestamp to nanoseconds so that timestamps sort as strings."""
+    seconds, dot, rest = timestamp.partition('.')
+    if not dot:
+        return timestamp
+    digits = len(rest) - len(rest.lstrip('0123456789'))
+    return '{}.{:0<9}{}'.format(seconds, rest[:digits], rest[digits:])
+
+def read_frames(response):
+    """Yields the payloads of a multiplexed Engine API log stream (a raw stream for services with a TTY)."""
+    header = response.read(8)
+    if header and header[0] not in '\x00\x01\x02':
+        yield header
+        for chunk in iter(lambda: response.read(4096), ''):
+            yield chunk
+        return
+    while len(header) == 8:
+        _, size = struct.unpack('>BxxxL', header)
+        yield response.read(size)
+        header = response.read(8)
+
+def merge_logs(streams, timestamps=False, limit=LOG_BUFFER, delay=LOG_DELAY):
+    """Prints the lines of `streams` (an ordered mapping of label to an iterable of `(timestamp, line)`) ordered by timestamp.
+
+    Every stream is read by a thread of its own into a buffer of at most `limit` lines. A line is printed once every
+    other running stream has a line buffered, or after it waited `delay` seconds for the streams that have not. Returns
+    an ordered mapping of the labels of failed streams to their exceptions.
+    """
+    condition = threading.Condition()
+    buffers = OrderedDict((label, deque()) for label in streams)
+    active = set(streams)
+    errors = OrderedDict()
+
+    def read(label):
+        try:
+            for timestamp, line in streams[label]:
+                with condition:
+                    while len(buffers[label]) >= limit:
+                        condition.wait(1)
+                    buffers[label].append((timestamp, line, time.time()))
+                    condition.notify_all()
+        except Exception as e:  # pylint: disable=broad-except
+            errors[label] = e
+        finally:
+            with condition:
+                active.discard(label)
+                condition.notify_all()
+
+    for label in streams:
+        thread = threading.Thread(target=read, args=(label,))
+        thread.daemon = True
+        thread.start()
+
+    while True:
+        with condition:
+            heads = [(buffer[0], label) for label, buffer in buffers.items() if buffer]
+            if not heads and not active:
+                break
+            oldest = min(heads) if heads else None
+            waiting = any(not buffers[label] for label in active)
+            if oldest is None or (waiting and time.time() - oldest[0][2] < delay):
+                condition.wait(delay)
+                continue
+            (timestamp, line, _), label = oldest
+            buffers[label].popleft()
+            condition.notify_all()
+        with OUTPUT.labeled(label):
+            OUTPUT.write('{} {}'.format(timestamp, line) if timestamps else line)
+    return errors
+
+def fan_out(docker_compose, hosts, parallel, command, executor_factory):
+    """Runs `command(target)` for a target of `docker_compose` per host, at most `parallel` clusters at a time.
+
+    Every cluster gets its own executor, state snapshot and output prefix; a failing cluster does not stop the others.
+    Prints a summary per cluster and exits with 1 if any of them failed.
+    """
+    docker_compose.translate()
+    seconds = OrderedDict()
+
+    def run(host):
+        start = time.time()
+        try:
+            with OUTPUT.labeled(host), TRACER.span(host, 'cluster'):
+                command(docker_compose.target(host, executor_factory()))
+        except SystemExit as e:
+            raise ComposeError('exited with status {}'.format(e.code))
+        finally:
+            seconds[host] = time.time() - start
+
+    errors = run_parallel(OrderedDict((host, functools.partial(run, host)) for host in hosts), {}, parallel, keep_going=True)
+
+    print '\n{:<40} {:<7} {:>9}  {}'.format('CLUSTER', 'STATUS', 'TIME', 'ERROR')
+    for host in hosts:
+        print '{:<40} {:<7} {:>8.1f}s  {}'.format(host, 'failed' if host in errors else 'ok', seconds.get(host, 0),
+                                                   str(errors.get(host, '')).strip())
+    print '\n{} clusters: {} succeeded, {} failed'.format(len(hosts), len(hosts) - len(errors), len(errors))
+    if errors:
+        sys.exit(1)
+
+def topological_sort(dependencies, describe=str):
+    """Returns the keys of `dependencies` (a mapping of key to the keys it depends on) so that every key comes after its
+    dependencies. Raises ComposeError if there is a cycle."""
+    result = []
+    state = {}
+
+    def visit(key, path):
+        if state.get(key) == 'done':
+            return
+        if state.get(key) == 'visiting':
+            raise ComposeError('dependency cycle: {}'.format(' -> '.join(describe(item) for item in path[path.index(key):] + [key])))
+        state[key] = 'visiting'
+        for dependency in dependencies.get(key, []):
+            if dependency in dependencies:
+                visit(dependency, path + [key])
+        state[key] = 'done'
+        result.append(key)
+
+    for key in dependencies:
+        visit(key, [])
+    return result
 
 def main():
     envs = {
@@ -358,11 +2287,7 @@ def main():
         'COMPOSE_HTTP_TIMEOUT': '60',
         'COMPOSE_TLS_VERSION': 'TLSv1'
     }
-    env_path = os.path.join(os.getcwd(), '.env')
-
-    if os.path.isfile(env_path):
-        with open(env_path) as env_file:
-            envs.update(dict(map(lambda line: line.strip().split('=', 1), (line for line in env_file if not line.startswith('#') and line.strip()))))
+    dotenv = load_dotenv(os.path.join(os.getcwd(), '.env'))
 
     map(lambda e: os.environ.update({e[0]: e[1]}), (e for e in envs.items() if not e[0] in os.environ))
 
@@ -372,31 +2297,137 @@ def main():
     parser.add_argument('-p', '--project-name', help='Specify an alternate project name (default: directory name)',
                         default=os.environ.get('COMPOSE_PROJECT_NAME'))
     parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--backend', choices=['cli', 'api'], default=os.environ.get('COMPOSE_SWARM_BACKEND', 'cli'),
+                        help='Run docker CLI commands or talk to the Engine API at DOCKER_HOST directly (default: cli)')
+    parser.add_argument('--timeout', metavar='SECONDS', type=float, help='Maximum time a single docker command or API request may take')
+    parser.add_argument('--total-timeout', metavar='SECONDS', type=float, help='Maximum time all docker commands and API requests may take together')
+    parser.add_argument('--cache', action='store_true', default=bool(os.environ.get('COMPOSE_SWARM_CACHE')),
+                        help='Cache the resolved compose model under ~/.cache to skip parsing while the inputs are unchanged')
+    parser.add_argument('-H', '--host', action='append', default=[],
+                        help='Manager of a swarm to run the command against; repeat to run it against several swarms (default: DOCKER_HOST)')
+    parser.add_argument('--targets', metavar='FILE', type=argparse.FileType(), help='File with one --host per line')
+    parser.add_argument('--host-parallel', metavar='N', type=int, default=4, help='Number of swarms to run the command against concurrently (default: 4)')
+    parser.add_argument('--trace', metavar='FILE', help='Write a Chrome trace of the run to FILE and a summary next to it')
+    parser.add_argument('--refresh', action='store_true', help='Reload the cluster state before every watch pass instead of keeping one snapshot')
     subparsers = parser.add_subparsers(title='Command')
     parser.add_argument('_service', metavar='service', nargs='*', help='List of services to run the command for')
 
     services_parser = argparse.ArgumentParser(add_help=False)
     services_parser.add_argument('service', nargs='*', help='List of services to run the command for')
+    services_parser.set_defaults(command_args=[])
+
+    wait_parser = argparse.ArgumentParser(add_help=False)
+    wait_parser.add_argument('--wait-timeout', metavar='SECONDS', type=float, default=300,
+                             help='Maximum time to wait for the services to converge (default: 300)')
 
     pull_parser = subparsers.add_parser('pull', help='Pull service images', add_help=False, parents=[services_parser])
-    pull_parser.set_defaults(command='pull')
+    pull_parser.set_defaults(command='pull', command_args=['parallel', 'per_node'])
+    pull_parser.add_argument('--parallel', metavar='N', type=int, default=8, help='Maximum number of concurrent pulls (default: 8)')
+    pull_parser.add_argument('--per-node', metavar='N', type=int, default=1, help='Maximum number of concurrent pulls on one node (default: 1)')
 
     rm_parser = subparsers.add_parser('rm', help='Stop and remove services', add_help=False, parents=[services_parser])
     rm_parser.set_defaults(command='service_remove')
     rm_parser.add_argument('-f', help='docker-compose compatibility; ignored', action='store_true')
 
-    start_parser = subparsers.add_parser('start', help='Start services', add_help=False, parents=[services_parser])
-    start_parser.set_defaults(command='service_start')
+    start_parser = subparsers.add_parser('start', help='Start services', add_help=False, parents=[services_parser, wait_parser])
+    start_parser.set_defaults(command='service_start', command_args=['wait', 'wait_timeout'])
+    start_parser.add_argument('--wait', action='store_true', help='Wait until the services run all their tasks and are healthy')
 
     stop_parser = subparsers.add_parser('stop', help='Stop services', add_help=False, parents=[services_parser])
     stop_parser.set_defaults(command='service_stop')
 
-    up_parser = subparsers.add_parser('up', help='Create and start services', add_help=False, parents=[services_parser])
-    up_parser.set_defaults(command='service_up')
+    retry_parser = argparse.ArgumentParser(add_help=False)
+    retry_parser.add_argument('--resume', action='store_true', help='Skip the operations an interrupted run of the same plan completed')
+    retry_parser.add_argument('--retries', metavar='N', type=int, default=0, help='Number of times to retry a failed operation (default: 0)')
+    retry_parser.add_argument('--retry-backoff', metavar='SECONDS', type=float, default=1,
+                              help='Time to wait before the first retry, doubled for every next one (default: 1)')
+
+    up_parser = subparsers.add_parser('up', help='Create and start services', add_help=False, parents=[services_parser, wait_parser, retry_parser])
+    up_parser.set_defaults(command='service_up', command_args=['parallel', 'wait', 'wait_timeout', 'stack', 'resume', 'retries', 'retry_backoff'])
+    up_parser.add_argument('--stack', action='store_true', help='Deploy the services with `docker stack deploy` as a single stack')
+    up_parser.add_argument('--wait', action='store_true', help='Wait until the services run all their tasks and are healthy')
     up_parser.add_argument('-d', help='docker-compose compatibility; ignored', action='store_true')
+    up_parser.add_argument('--parallel', metavar='N', type=int, default=1, help='Number of networks, volumes and services to create concurrently (default: 1)')
+
+    watch_parser = subparsers.add_parser('watch', help='Create and start services and keep them in sync with the compose files', add_help=False,
+                                         parents=[services_parser])
+    watch_parser.set_defaults(command='watch', command_args=['files', 'parallel', 'debounce'])
+    watch_parser.add_argument('--parallel', metavar='N', type=int, default=1, help='Number of networks, volumes and services to create concurrently (default: 1)')
+    watch_parser.add_argument('--debounce', metavar='SECONDS', type=float, default=WATCH_DEBOUNCE,
+                              help='Time without further changes to wait for before applying them (default: {})'.format(WATCH_DEBOUNCE))
+
+    ps_parser = subparsers.add_parser('ps', help='List the tasks of services', add_help=False, parents=[services_parser])
+    ps_parser.set_defaults(command='ps')
+
+    logs_parser = subparsers.add_parser('logs', help='Show the logs of services', add_help=False, parents=[services_parser])
+    logs_parser.set_defaults(command='logs', command_args=['follow', 'tail', 'timestamps'])
+    logs_parser.add_argument('-f', '--follow', action='store_true', help='Follow the log output')
+    logs_parser.add_argument('-t', '--timestamps', action='store_true', help='Show timestamps')
+    logs_parser.add_argument('--tail', metavar='N', help='Number of lines to show from the end of the logs of each service (default: all)')
+
+    wait_command_parser = subparsers.add_parser('wait', help='Wait until services run all their tasks and are healthy', add_help=False,
+                                                parents=[services_parser, wait_parser])
+    wait_command_parser.set_defaults(command='wait', command_args=['wait_timeout'])
+
+    convert_parser = subparsers.add_parser('convert', help='Convert the compose files to a version 3 stack file', add_help=False,
+                                           parents=[services_parser])
+    convert_parser.set_defaults(command='convert', command_args=['output'])
+    convert_parser.add_argument('-o', '--output', metavar='FILE', help='Write the stack file to FILE instead of stdout')
+
+    plan_parser = subparsers.add_parser('plan', help='Compile the networks, volumes and services to create into a JSON plan', add_help=False,
+                                        parents=[services_parser])
+    plan_parser.set_defaults(command='plan', command_args=['output'])
+    plan_parser.add_argument('-o', '--output', metavar='FILE', help='Write the plan to FILE instead of stdout')
+
+    apply_parser = subparsers.add_parser('apply', help='Create and start the services of a plan without reading the compose files', add_help=False,
+                                         parents=[wait_parser, retry_parser])
+    apply_parser.set_defaults(command='apply', service=[])
+    apply_parser.add_argument('--plan', metavar='FILE', type=argparse.FileType(), required=True, help='Plan written by the plan command')
+    apply_parser.add_argument('--parallel', metavar='N', type=int, default=1, help='Number of networks, volumes and services to create concurrently (default: 1)')
+    apply_parser.add_argument('--wait', action='store_true', help='Wait until the services run all their tasks and are healthy')
 
     args = parser.parse_args(sys.argv[1:])
 
+    global DEBUG
+    DEBUG = args.dry_run
+
+    global TRACER
+    if args.trace:
+        TRACER = Tracer()
+
+    hosts = list(args.host)
+    if args.targets:
+        hosts.extend(line.strip() for line in args.targets if line.strip() and not line.strip().startswith('#'))
+
+    def run_command(docker_compose, command):
+        if len(hosts) > 1:
+            fan_out(docker_compose, hosts, args.host_parallel, command, lambda: Executor(args.timeout, args.total_timeout))
+        else:
+            command(docker_compose)
+
+    if args.command == 'apply':
+        try:
+            with TRACER.span('load', 'phase'):
+                args.plan = json.load(args.plan, object_pairs_hook=OrderedDict)
+            docker_compose = DockerCompose(OrderedDict(), args.plan.get('project'), os.getcwd() + '/', [], args.refresh, args.backend,
+                                           Executor(args.timeout, args.total_timeout), host=hosts[0] if hosts else None)
+            with TRACER.span(args.command, 'phase'):
+                run_command(docker_compose, lambda target: target.apply(args.plan, args.parallel, args.wait, args.wait_timeout, args.resume,
+                                                                       args.retries, args.retry_backoff))
+        except ValueError as e:
+            print >> sys.stderr, ('Error: invalid plan: {}'.format(e))
+            sys.exit(1)
+        except CommandError as e:
+            print >> sys.stderr, ('Error: {}'.format(e))
+            sys.exit(e.returncode)
+        except ComposeError as e:
+            print >> sys.stderr, ('Error: {}'.format(e))
+            sys.exit(1)
+        finally:
+            if args.trace:
+                TRACER.write(args.trace)
+        return
+
     if not args.file:
         try:
             args.file = map(lambda f: open(f), os.environ['COMPOSE_FILE'].split(':'))
@@ -405,33 +2436,72 @@ def main():
             parser.print_help()
             sys.exit(1)
 
-    global DEBUG
-    DEBUG = args.dry_run
-
     compose_base_dir = os.path.dirname(os.path.abspath(args.file[0].name))
+    args.files = [f.name for f in args.file]
+    if args.command == 'watch' and len(hosts) > 1:
+        print >> sys.stderr, ('Error: watch runs against a single swarm')
+        sys.exit(1)
 
     if args.project_name is None:
         args.project_name = os.path.basename(compose_base_dir)
 
-    # Decode and merge the compose files
-    compose_dicts = map(lambda f: yaml.load(f, yodl.OrderedDictYAMLLoader), args.file)
-    merged_compose = reduce(merge, compose_dicts)
+    loader = ComposeLoader()
+    cache = ModelCache() if args.cache else None
+    cache_key = cache.key([f.name for f in args.file], args.project_name) if cache else None
 
-    docker_compose = DockerCompose(merged_compose, args.project_name, compose_base_dir + '/', args.service)
-    getattr(docker_compose, args.command)()
+    try:
+        with TRACER.span('load', 'phase'):
+            cache_entry = cache.get(cache_key) if cache else None
+            if cache_entry:
+                merged_compose = cache_entry['compose']
+            else:
+                # Decode and merge the compose files
+                compose_dicts = map(lambda f: loader.load(f.name, f), args.file)
+                merged_compose = reduce(merge, compose_dicts)
+
+        with TRACER.span('resolve', 'phase'):
+            docker_compose = DockerCompose(merged_compose, args.project_name, compose_base_dir + '/', args.service, args.refresh, args.backend,
+                                           Executor(args.timeout, args.total_timeout), loader, cache_entry and cache_entry['specs'],
+                                           hosts[0] if hosts else None, dotenv=dotenv)
+        command_args = dict((arg, getattr(args, arg)) for arg in args.command_args)
+        try:
+            with TRACER.span(args.command, 'phase'):
+                if args.command in ('plan', 'convert'):
+                    getattr(docker_compose, args.command)(**command_args)
+                else:
+                    run_command(docker_compose, lambda target: getattr(target, args.command)(**command_args))
+        finally:
+            if cache and (not cache_entry or len(docker_compose._service_specs) > len(cache_entry['specs'])):  # pylint: disable=protected-access
+                inputs = cache_entry['inputs'] if cache_entry else cache.fingerprints(list(loader.paths()) + docker_compose.input_files())
+                cache.put(cache_key, inputs, docker_compose.model(), docker_compose._service_specs,  # pylint: disable=protected-access
+                          docker_compose.interpolator.values())
+    except CommandError as e:
+        print >> sys.stderr, ('Error: {}'.format(e))
+        sys.exit(e.returncode)
+    except ComposeError as e:
+        print >> sys.stderr, ('Error: {}'.format(e))
+        sys.exit(1)
+    finally:
+        if args.trace:
+            TRACER.write(args.trace)
 
 
 # Based on http://stackoverflow.com/questions/7204805/dictionaries-of-dictionaries-merge/7205107#7205107
 def merge(a, b, path=None, conflict_resolver=None):
-    """merges b into a"""
+    """merges b into a and returns the result
+
+    Neither a nor b is modified: the containers on the merged paths are copied, everything else is shared, so parsed
+    files can be merged again and again.
+    """
     if path is None:
         path = []
+    a = copy.copy(a)
     for key in b:
         if key in a:
             if isinstance(a[key], dict) and isinstance(b[key], dict):
-                merge(a[key], b[key], path + [str(key)], conflict_resolver)
+                a[key] = merge(a[key], b[key], path + [str(key)], conflict_resolver)
             elif isinstance(a[key], list) and isinstance(b[key], list):
-                a[key].extend(b[key])
+                a[key] = a[key] + b[key]
             elif a[key] == b[key]:
                 pass  # same leaf value
             else:
@@ -443,6 +2513,257 @@ def merge(a, b, path=None, conflict_resolver=None):
             a[key] = b[key]
     return a
 
+def load_dotenv(path, loaded=()):
+    """Sets the variables of the `.env` file at `path` that the environment does not set itself, replacing the ones
+    `loaded` by an earlier call. Returns the names of the variables it set."""
+    for name in loaded:
+        os.environ.pop(name, None)
+    values = {}
+    if os.path.isfile(path):
+        with open(path) as env_file:
+            values = dict(line.strip().split('=', 1) for line in env_file if not line.startswith('#') and line.strip())
+    names = set(name for name in values if name not in os.environ)
+    os.environ.update((name, values[name]) for name in names)
+    return names
+
+def node_attributes(node):
+    """Returns the attributes placement constraints can refer to, keyed the way constraints name them."""
+    spec = node.get('Spec') or {}
+    description = node.get('Description') or {}
+    attributes = {
+        'node.id': node.get('ID'),
+        'node.hostname': description.get('Hostname'),
+        'node.role': spec.get('Role'),
+        'node.platform.os': (description.get('Platform') or {}).get('OS'),
+        'node.platform.arch': (description.get('Platform') or {}).get('Architecture'),
+    }
+    attributes.update(('node.labels.' + key, value) for key, value in (spec.get('Labels') or {}).items())
+    attributes.update(('engine.labels.' + key, value) for key, value in ((description.get('Engine') or {}).get('Labels') or {}).items())
+    return attributes
+
+def match_constraint(constraint, attributes):
+    """Evaluates a swarm mode placement constraint (or a legacy `node==name`/`label==value` one) against node attributes.
+
+    Constraints that can not be evaluated are treated as satisfied, so an image is rather pulled once too often than missed.
+    """
+    match = re.match(r'^\s*([\w.\-]+)\s*(==|!=)(~?)\s*(.*?)\s*$', constraint)
+    if not match:
+        OUTPUT.write('WARNING: can not evaluate constraint "{}"'.format(constraint), sys.stderr)
+        return True
+    key, operator, soft, value = match.groups()
+    if soft:
+        return True  # a preference only
+    if key == 'node':
+        key = 'node.hostname'
+    elif '.' not in key:
+        key = 'engine.labels.' + key
+    if key not in attributes and not key.startswith(('node.labels.', 'engine.labels.')):
+        OUTPUT.write('WARNING: can not evaluate constraint "{}"'.format(constraint), sys.stderr)
+        return True
+    return (attributes.get(key) == value) == (operator == '==')
+
+def total_bytes(counts):
+    """Returns the sum of byte `counts`, or None if any of them is not known."""
+    counts = list(counts)
+    return None if None in counts else sum(counts)
+
+def format_bytes(count):
+    if count is None:
+        return '-'
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if count < 1024 or unit == 'GB':
+            return '{:.1f} {}'.format(count, unit) if unit != 'B' else '{} B'.format(count)
+        count /= 1024.0
+
+def format_options(options):
+    return ''.join('--opt {} '.format(key if value is None else '{}={}'.format(key, value)) for key, value in options.items())
+
+def parse_duration(value):
+    """Converts a Go duration string (as accepted by the docker CLI, e.g. `1m30s`) to nanoseconds."""
+    if isinstance(value, (int, long, float)):
+        return int(value * 10 ** 9)
+    units = {'ns': 1, 'us': 10 ** 3, 'ms': 10 ** 6, 's': 10 ** 9, 'm': 60 * 10 ** 9, 'h': 3600 * 10 ** 9}
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ns|us|ms|s|m|h)', value)
+    if not parts or ''.join(number + unit for number, unit in parts) != value:
+        raise ComposeError('invalid duration "{}"'.format(value))
+    return int(sum(float(number) * units[unit] for number, unit in parts))
+
+def parse_bytes(value):
+    match = re.match(r'^(\d+(?:\.\d+)?)\s*([bkmgt]?)b?$', str(value).strip().lower())
+    if not match:
+        raise ComposeError('invalid size "{}"'.format(value))
+    return int(float(match.group(1)) * 1024 ** 'bkmgt'.index(match.group(2) or 'b'))
+
+def split_image_tag(image):
+    if '@' in image:
+        return image, ''
+    name, _, tag = image.rpartition(':')
+    if not name or '/' in tag:
+        return image, 'latest'
+    return name, tag
+
+def registry_auth_headers(image):
+    """Returns the `X-Registry-Auth` header for the registry of the image, taken from the docker CLI config."""
+    try:
+        with open(os.path.join(os.environ.get('DOCKER_CONFIG') or os.path.expanduser('~/.docker'), 'config.json')) as config_file:
+            auths = json.load(config_file).get('auths') or {}
+    except (IOError, ValueError):
+        return {}
+
+    first = image.split('/', 1)[0]
+    registry = first if '/' in image and ('.' in first or ':' in first or first == 'localhost') else 'https://index.docker.io/v1/'
+    for address, auth in auths.items():
+        if address.split('://', 1)[-1].rstrip('/') == registry.split('://', 1)[-1].rstrip('/') and 'auth' in auth:
+            username, _, password = base64.b64decode(auth['auth']).partition(':')
+            return {'X-Registry-Auth': base64.urlsafe_b64encode(json.dumps({'username': username, 'password': password, 'serveraddress': address}))}
+    return {}
+
+def service_spec_from_flags(name, flags, image, command):
+    """Builds the Engine API service spec equivalent to `docker service create` with the given flags."""
+    container = OrderedDict([('Image', image), ('Env', []), ('Mounts', []), ('Hosts', [])])
+    task = OrderedDict([('ContainerSpec', container), ('Placement', {'Constraints': []}), ('RestartPolicy', {}),
+                        ('Resources', {'Limits': {}}), ('Networks', [])])
+    spec = OrderedDict([('Name', name), ('Labels', {}), ('TaskTemplate', task), ('Mode', {'Replicated': {'Replicas': 1}}),
+                        ('UpdateConfig', {}), ('EndpointSpec', {'Ports': []})])
+    if command:
+        container['Args'] = list(command)
+
+    healthcheck = {}
+    for flag, value in flags:
+        if flag == '--env':
+            container['Env'].append(value)
+        elif flag == '--label':
+            key, _, label = value.partition('=')
+            spec['Labels'][key] = label
+        elif flag == '--constraint':
+            task['Placement']['Constraints'].append(value)
+        elif flag == '--mount':
+            options = dict(part.split('=', 1) for part in value.split(','))
+            container['Mounts'].append({'Type': options.get('type', 'volume'), 'Source': options.get('src'), 'Target': options.get('dst'),
+                                        'ReadOnly': options.get('readonly') in ('1', 'true')})
+        elif flag == '--publish':
+            ports, _, protocol = str(value).partition('/')
+            ports = ports.split(':')
+            spec['EndpointSpec']['Ports'].append({'Protocol': protocol or 'tcp', 'TargetPort': int(ports[-1]),
+                                                  'PublishedPort': int(ports[-2]) if len(ports) > 1 else None})
+        elif flag == '--network':
+            task['Networks'].append({'Target': value})
+        elif flag == '--host':
+            host, _, address = value.partition(':')
+            container['Hosts'].append('{} {}'.format(address, host))
+        elif flag == '--hostname':
+            container['Hostname'] = value
+        elif flag == '--limit-memory':
+            task['Resources']['Limits']['MemoryBytes'] = parse_bytes(value)
+        elif flag == '--mode':
+            spec['Mode'] = {'Global': {}} if value == 'global' else {'Replicated': {'Replicas': 1}}
+        elif flag == '--replicas':
+            spec['Mode'] = {'Replicated': {'Replicas': int(value)}}
+        elif flag == '--restart-condition':
+            task['RestartPolicy']['Condition'] = value
+        elif flag in ('--restart-delay', '--restart-window'):
+            task['RestartPolicy'][flag[len('--restart-'):].capitalize()] = parse_duration(value)
+        elif flag == '--restart-max-attempts':
+            task['RestartPolicy']['MaxAttempts'] = int(value)
+        elif flag in ('--update-delay', '--update-monitor'):
+            spec['UpdateConfig'][flag[len('--update-'):].capitalize()] = parse_duration(value)
+        elif flag == '--update-failure-action':
+            spec['UpdateConfig']['FailureAction'] = value
+        elif flag == '--update-max-failure-ratio':
+            spec['UpdateConfig']['MaxFailureRatio'] = float(value)
+        elif flag == '--update-parallelism':
+            spec['UpdateConfig']['Parallelism'] = int(value)
+        elif flag == '--log-driver':
+            task.setdefault('LogDriver', {'Options': {}})['Name'] = value
+        elif flag == '--log-opt':
+            key, _, option = value.partition('=')
+            task.setdefault('LogDriver', {'Options': {}})['Options'][key] = option
+        elif flag in ('--health-cmd', '--healthcheck-cmd'):
+            healthcheck['Test'] = ['CMD-SHELL', value]
+        elif flag in ('--health-interval', '--health-timeout'):
+            healthcheck[flag[len('--health-'):].capitalize()] = parse_duration(value)
+        elif flag == '--health-retries':
+            healthcheck['Retries'] = int(value)
+        elif flag == '--no-healthcheck':
+            healthcheck['Test'] = ['NONE']
+        else:
+            raise ComposeError('flag {} is not supported by the API backend'.format(flag))
+
+    if healthcheck:
+        container['Healthcheck'] = healthcheck
+    return spec
+
+def service_flags_from_spec(spec, network_names):
+    """Rebuilds `(flags, image, command)` of a service from its Engine API spec, for services created without the spec
+    labels. Only the mode and the flags that `docker service update` changes with `<flag>-add`/`<flag>-rm` are rebuilt;
+    networks are named with `network_names` (by ID)."""
+    task = spec.get('TaskTemplate') or {}
+    container = task.get('ContainerSpec') or {}
+    flags = []
+    if 'Global' in (spec.get('Mode') or {}):
+        flags.append(['--mode', 'global'])
+    flags.extend(['--env', env] for env in container.get('Env') or [])
+    flags.extend(['--label', '{}={}'.format(*label)] for label in sorted((spec.get('Labels') or {}).items()))
+    flags.extend(['--constraint', constraint] for constraint in (task.get('Placement') or {}).get('Constraints') or [])
+    for mount in container.get('Mounts') or []:
+        value = 'src={},dst={},readonly={}'.format(mount.get('Source'), mount.get('Target'), 1 if mount.get('ReadOnly') else 0)
+        flags.append(['--mount', 'type=bind,' + value if mount.get('Type') == 'bind' else value])
+    for port in (spec.get('EndpointSpec') or {}).get('Ports') or []:
+        value = '{}:{}'.format(port['PublishedPort'], port['TargetPort']) if port.get('PublishedPort') else str(port['TargetPort'])
+        flags.append(['--publish', value if port.get('Protocol', 'tcp') == 'tcp' else '{}/{}'.format(value, port['Protocol'])])
+    for network in task.get('Networks') or spec.get('Networks') or []:
+        flags.append(['--network', network_names.get(network['Target'], network['Target'])])
+    for host in container.get('Hosts') or []:
+        address, _, name = host.partition(' ')
+        flags.append(['--host', '{}:{}'.format(name, address)])
+    return flags, container.get('Image'), container.get('Args') or []
+
+def format_flag(key, value=None):
+    if value is None:
+        return [key, '\\\n']
+    elif isinstance(value, (int, long, float)):
+        return [key, str(value), '\\\n']
+    else:
+        return [key, shellquote(value), '\\\n']
+
+def group_flags(flags):
+    result = OrderedDict()
+    for flag, value in flags:
+        result.setdefault(flag, []).append(value)
+    return result
+
+def spec_update_flags(old_flags, new_flags):
+    """Returns the `docker service update` flags that turn a service created with `old_flags` into one created with
+    `new_flags`, leaving everything that did not change untouched."""
+    old, new = group_flags(old_flags), group_flags(new_flags)
+    result = []
+
+    if any(old.get(flag) != new.get(flag) for flag in ('--log-driver', '--log-opt')):
+        # Log options are replaced as a whole together with the driver.
+        result.extend([flag, value] for flag in ('--log-driver', '--log-opt') for value in new.get(flag, []))
+
+    for flag in list(old) + [flag for flag in new if flag not in old]:
+        old_values, new_values = old.get(flag, []), new.get(flag, [])
+        if old_values == new_values or flag in ('--log-driver', '--log-opt'):
+            continue
+        if flag in UPDATE_LIST_FLAGS:
+            key = UPDATE_LIST_FLAGS[flag]
+            new_keys = set(key(value) for value in new_values)
+            replaced = set(key(value) for value in old_values if value not in new_values) if flag in UPDATE_REPLACED_FLAGS else set()
+            result.extend([flag + '-rm', item] for item in OrderedDict.fromkeys(key(value) for value in old_values)
+                          if item not in new_keys or item in replaced)
+            result.extend([flag + '-add', value] for value in new_values if value not in old_values or key(value) in replaced)
+        elif flag == '--mode':
+            OUTPUT.write('WARNING: service mode can not be changed without removing the service', sys.stderr)
+        elif new_values:
+            result.append([flag, new_values[-1]])
+        elif flag in UPDATE_RESETS:
+            result.append(UPDATE_RESETS[flag])
+        else:
+            OUTPUT.write('WARNING: {} can not be unset without removing the service'.format(flag), sys.stderr)
+
+    return result
+
 def shellquote(s):
     return "'" + s.replace("'", "'\\''") + "'"
 
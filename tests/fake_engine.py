@@ -0,0 +1,146 @@
+# pylint: disable=locally-disabled, C0111, line-too-long
+
+"""In-memory stand-in for the Docker Engine API served on a unix socket.
+
+Implements the endpoints the API backend uses for networks, volumes, services, tasks and nodes, keeps service versions
+the way swarm does (an update with a stale version is rejected) and records every request in `requests`:
+
+    engine = FakeEngine(path)
+    engine.start()
+    backend = ApiBackend('unix://' + path)
+    ...
+    engine.stop()
+"""
+
+import BaseHTTPServer
+import json
+import os
+import re
+import SocketServer
+import threading
+import urlparse
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def reply(self, status, body=None):
+        data = json.dumps(body) if body is not None else ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_method(self, method):
+        url = urlparse.urlparse(self.path)
+        path = re.sub(r'^/v[0-9.]+', '', url.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        self.server.requests.append((method, path, query, body, dict(self.headers)))
+        with self.server.lock:
+            status, result = self.server.dispatch(method, path, query, body)
+        self.reply(status, result)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        self.handle_method('GET')
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        self.handle_method('POST')
+
+    def do_DELETE(self):  # pylint: disable=invalid-name
+        self.handle_method('DELETE')
+
+
+class FakeEngine(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path):
+        SocketServer.UnixStreamServer.__init__(self, path, Handler)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.services = {}
+        self.networks = {}
+        self.volumes = {}
+        self.nodes = [{'ID': 'node1', 'Description': {'Hostname': 'node1'}, 'Status': {'State': 'ready'},
+                       'Spec': {'Role': 'manager', 'Labels': {}}}]
+        self._ids = 0
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        os.remove(self.server_address)
+
+    def new_id(self, prefix):
+        self._ids += 1
+        return '{}{:04d}'.format(prefix, self._ids)
+
+    def find_service(self, key):
+        for service in self.services.values():
+            if key in (service['ID'], service['Spec']['Name']):
+                return service
+        return None
+
+    def tasks(self, service):
+        mode = service['Spec'].get('Mode') or {}
+        replicas = len(self.nodes) if 'Global' in mode else (mode.get('Replicated') or {}).get('Replicas', 1)
+        return [{'ID': '{}.{}'.format(service['ID'], slot), 'ServiceID': service['ID'], 'Slot': slot, 'NodeID': self.nodes[0]['ID'],
+                 'DesiredState': 'running', 'Status': {'State': 'running', 'Message': 'started'}} for slot in range(1, replicas + 1)]
+
+    def dispatch(self, method, path, query, body):  # pylint: disable=too-many-return-statements, too-many-branches
+        filters = json.loads(query.get('filters') or '{}')
+        parts = path.strip('/').split('/')
+
+        if method == 'GET' and parts == ['services']:
+            names = filters.get('name')
+            return 200, [service for service in self.services.values() if not names or service['Spec']['Name'] in names]
+        if method == 'POST' and parts == ['services', 'create']:
+            if self.find_service(body['Name']):
+                return 409, {'message': 'service {} already exists'.format(body['Name'])}
+            service_id = self.new_id('service')
+            self.services[service_id] = {'ID': service_id, 'Version': {'Index': 1}, 'Spec': body}
+            return 201, {'ID': service_id}
+        if parts[0] == 'services' and len(parts) >= 2:
+            service = self.find_service(parts[1])
+            if service is None:
+                return 404, {'message': 'service {} not found'.format(parts[1])}
+            if method == 'GET' and len(parts) == 2:
+                return 200, service
+            if method == 'POST' and parts[2:] == ['update']:
+                if int(query.get('version', 0)) != service['Version']['Index']:
+                    return 500, {'message': 'update out of sequence'}
+                service['Spec'] = body
+                service['Version']['Index'] += 1
+                return 200, {'Warnings': None}
+            if method == 'DELETE' and len(parts) == 2:
+                del self.services[service['ID']]
+                return 200, None
+
+        if method == 'GET' and parts == ['tasks']:
+            ids = filters.get('service')
+            return 200, [task for service in self.services.values() if not ids or service['ID'] in ids for task in self.tasks(service)]
+        if method == 'GET' and parts == ['nodes']:
+            return 200, self.nodes
+        if method == 'GET' and parts == ['networks']:
+            return 200, self.networks.values()
+        if method == 'POST' and parts == ['networks', 'create']:
+            network_id = self.new_id('network')
+            self.networks[body['Name']] = {'Id': network_id, 'Name': body['Name'], 'Driver': body.get('Driver'), 'Options': body.get('Options')}
+            return 201, {'Id': network_id}
+        if method == 'GET' and parts == ['volumes']:
+            return 200, {'Volumes': self.volumes.values(), 'Warnings': None}
+        if method == 'POST' and parts == ['volumes', 'create']:
+            self.volumes[body['Name']] = {'Name': body['Name'], 'Driver': body.get('Driver'), 'Options': body.get('DriverOpts')}
+            return 201, self.volumes[body['Name']]
+
+        return 404, {'message': 'page not found'}
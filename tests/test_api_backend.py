@@ -0,0 +1,179 @@
+# pylint: disable=locally-disabled, C0111, line-too-long
+
+"""Tests of the Engine API backend against the fake engine in `fake_engine.py`.
+
+Run with `python -m unittest discover tests`.
+"""
+
+import base64
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from docker_compose_swarm_mode import ApiBackend, ApiError, registry_auth_headers, service_spec_from_flags  # pylint: disable=wrong-import-position
+from fake_engine import FakeEngine  # pylint: disable=wrong-import-position
+
+
+class ApiBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine = FakeEngine(os.path.join(self.directory, 'docker.sock'))
+        self.engine.start()
+        self.backend = ApiBackend('unix://' + self.engine.server_address)
+        self.environ = dict(os.environ)
+        os.environ['DOCKER_CONFIG'] = self.directory
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        self.engine.stop()
+        shutil.rmtree(self.directory)
+
+    def requests(self, method, path):
+        return [request for request in self.engine.requests if request[:2] == (method, path)]
+
+    def test_create_and_list(self):
+        self.backend.create_network('app_front', 'overlay', {'encrypted': None})
+        self.backend.create_volume('app_data', None, {'size': 10})
+        self.backend.create_service('app_web', [['--network', 'app_front'], ['--env', 'A=1']], 'nginx', [])
+
+        self.assertEqual(self.backend.list('network'), set(['app_front']))
+        self.assertEqual(self.backend.list('volume'), set(['app_data']))
+        self.assertEqual(self.backend.list('service'), set(['app_web']))
+        self.assertEqual(self.engine.networks['app_front']['Options'], {'encrypted': ''})
+        self.assertEqual(self.engine.volumes['app_data'], {'Name': 'app_data', 'Driver': 'local', 'Options': {'size': '10'}})
+        self.assertEqual([spec['Name'] for spec in self.backend.inspect_services(['app_web'])], ['app_web'])
+        self.assertEqual(self.backend.network_names(), {self.engine.networks['app_front']['Id']: 'app_front'})
+
+    def test_update_replaces_spec(self):
+        self.backend.create_service('app_web', [['--env', 'A=1'], ['--replicas', 2]], 'nginx', [])
+        self.backend.update_service('app_web', [], [['--env', 'A=2'], ['--replicas', 2]], 'nginx:1.13', ['nginx', '-g', 'daemon off;'])
+        self.backend.update_service('app_web', [], [['--env', 'A=3'], ['--replicas', 2]], 'nginx:1.13', [])
+
+        service = self.engine.find_service('app_web')
+        self.assertEqual(service['Version']['Index'], 3)
+        self.assertEqual(service['Spec']['TaskTemplate']['ContainerSpec']['Env'], ['A=3'])
+        self.assertEqual(service['Spec']['TaskTemplate']['ContainerSpec']['Image'], 'nginx:1.13')
+        self.assertEqual([request[2] for request in self.requests('POST', '/services/app_web/update')], [{'version': '1'}, {'version': '2'}])
+
+    def test_update_missing_service(self):
+        with self.assertRaises(ApiError) as context:
+            self.backend.update_service('app_missing', [], [], 'nginx', [])
+        self.assertEqual(context.exception.returncode, 404)
+
+    def test_scale(self):
+        self.backend.create_service('app_web', [], 'nginx', [])
+        self.backend.create_service('app_db', [['--replicas', 2]], 'postgres', [])
+        self.backend.scale({'app_web': 3, 'app_db': '2'})
+
+        self.assertEqual(self.engine.find_service('app_web')['Spec']['Mode'], {'Replicated': {'Replicas': 3}})
+        self.assertEqual(len(self.requests('POST', '/services/app_web/update')), 1)
+        self.assertEqual(self.requests('POST', '/services/app_db/update'), [])
+
+    def test_tasks(self):
+        self.backend.create_service('app_web', [['--replicas', 2]], 'nginx', [])
+        self.backend.create_service('app_db', [], 'postgres', [])
+        self.backend.create_service('other', [], 'redis', [])
+
+        tasks = self.backend.tasks(['app_web', 'app_db'])
+        self.assertEqual(list(tasks), ['app_web', 'app_db'])
+        self.assertEqual([task['Slot'] for task in tasks['app_web']], [1, 2])
+        self.assertEqual(len(tasks['app_db']), 1)
+        self.backend.tasks(['app_web'])
+        self.assertEqual(len(self.requests('GET', '/services')), 1)
+
+    def test_remove_services(self):
+        self.backend.create_service('app_web', [], 'nginx', [])
+        self.backend.remove_services(['app_web'])
+        self.assertEqual(self.backend.list('service'), set())
+
+    def test_registry_auth_header_is_sent(self):
+        with open(os.path.join(self.directory, 'config.json'), 'w') as config_file:
+            json.dump({'auths': {'registry.example.com': {'auth': base64.b64encode('user:secret')}}}, config_file)
+        self.backend.create_service('app_web', [], 'registry.example.com/web', [])
+        self.assertIn('x-registry-auth', self.requests('POST', '/services/create')[0][4])
+
+    def test_connection_error(self):
+        backend = ApiBackend('unix://' + os.path.join(self.directory, 'missing.sock'))
+        with self.assertRaises(ApiError):
+            backend.list('service')
+
+
+class ServiceSpecFromFlagsTest(unittest.TestCase):
+    def test_flags(self):
+        spec = service_spec_from_flags('app_web', [
+            ['--env', 'A=1'], ['--label', 'tier=front'], ['--constraint', 'node.role == manager'],
+            ['--mount', 'type=bind,src=/srv,dst=/data,readonly=1'], ['--mount', 'src=app_data,dst=/var,readonly=0'],
+            ['--publish', '8080:80'], ['--publish', '53/udp'], ['--network', 'app_front'], ['--host', 'db:10.0.0.2'],
+            ['--replicas', 3], ['--restart-condition', 'on-failure'], ['--restart-delay', '5s'], ['--limit-memory', '512m'],
+            ['--update-parallelism', 2], ['--log-driver', 'syslog'], ['--log-opt', 'tag=web'],
+            ['--health-cmd', 'true'], ['--health-interval', '10s'], ['--health-retries', 3]], 'nginx', ['nginx', '-g', 'daemon off;'])
+
+        task = spec['TaskTemplate']
+        container = task['ContainerSpec']
+        self.assertEqual(spec['Name'], 'app_web')
+        self.assertEqual(spec['Labels'], {'tier': 'front'})
+        self.assertEqual(spec['Mode'], {'Replicated': {'Replicas': 3}})
+        self.assertEqual(spec['UpdateConfig'], {'Parallelism': 2})
+        self.assertEqual(spec['EndpointSpec']['Ports'], [{'Protocol': 'tcp', 'TargetPort': 80, 'PublishedPort': 8080},
+                                                         {'Protocol': 'udp', 'TargetPort': 53, 'PublishedPort': None}])
+        self.assertEqual(container['Image'], 'nginx')
+        self.assertEqual(container['Args'], ['nginx', '-g', 'daemon off;'])
+        self.assertEqual(container['Env'], ['A=1'])
+        self.assertEqual(container['Mounts'], [{'Type': 'bind', 'Source': '/srv', 'Target': '/data', 'ReadOnly': True},
+                                               {'Type': 'volume', 'Source': 'app_data', 'Target': '/var', 'ReadOnly': False}])
+        self.assertEqual(container['Hosts'], ['10.0.0.2 db'])
+        self.assertEqual(container['Healthcheck'], {'Test': ['CMD-SHELL', 'true'], 'Interval': 10 * 10 ** 9, 'Retries': 3})
+        self.assertEqual(task['Placement'], {'Constraints': ['node.role == manager']})
+        self.assertEqual(task['Networks'], [{'Target': 'app_front'}])
+        self.assertEqual(task['RestartPolicy'], {'Condition': 'on-failure', 'Delay': 5 * 10 ** 9})
+        self.assertEqual(task['Resources'], {'Limits': {'MemoryBytes': 512 * 1024 ** 2}})
+        self.assertEqual(task['LogDriver'], {'Name': 'syslog', 'Options': {'tag': 'web'}})
+
+    def test_global_mode(self):
+        self.assertEqual(service_spec_from_flags('app_agent', [['--mode', 'global']], 'agent', [])['Mode'], {'Global': {}})
+
+
+class RegistryAuthHeadersTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ['DOCKER_CONFIG'] = self.directory
+        with open(os.path.join(self.directory, 'config.json'), 'w') as config_file:
+            json.dump({'auths': {
+                'https://index.docker.io/v1/': {'auth': base64.b64encode('hub:one')},
+                'registry.example.com:5000': {'auth': base64.b64encode('private:two:three')},
+            }}, config_file)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.directory)
+
+    def auth(self, image):
+        headers = registry_auth_headers(image)
+        return json.loads(base64.urlsafe_b64decode(headers['X-Registry-Auth'])) if headers else None
+
+    def test_docker_hub(self):
+        self.assertEqual(self.auth('nginx:1.13'), {'username': 'hub', 'password': 'one', 'serveraddress': 'https://index.docker.io/v1/'})
+        self.assertEqual(self.auth('library/nginx')['username'], 'hub')
+
+    def test_private_registry(self):
+        self.assertEqual(self.auth('registry.example.com:5000/team/app:2'),
+                         {'username': 'private', 'password': 'two:three', 'serveraddress': 'registry.example.com:5000'})
+
+    def test_unknown_registry(self):
+        self.assertIsNone(self.auth('other.example.com/app'))
+
+    def test_missing_config(self):
+        os.remove(os.path.join(self.directory, 'config.json'))
+        self.assertEqual(registry_auth_headers('nginx'), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
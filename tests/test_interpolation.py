@@ -0,0 +1,114 @@
+# pylint: disable=locally-disabled, C0111, line-too-long
+
+"""Tests of variable interpolation in the compose model.
+
+Run with `python -m unittest discover tests`.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from docker_compose_swarm_mode import ComposeError, Interpolator, compile_template, escape_variables, load_dotenv  # pylint: disable=wrong-import-position
+
+
+class CompileTemplateTest(unittest.TestCase):
+    def test_literal(self):
+        self.assertEqual(compile_template('nginx:latest'), ('nginx:latest',))
+        self.assertEqual(compile_template(''), ())
+
+    def test_variables(self):
+        self.assertEqual(compile_template('$IMAGE:${TAG:-latest}'), (('IMAGE', None, ''), ':', ('TAG', ':-', 'latest')))
+        self.assertEqual(compile_template('${A-x}${B:?no B}${C?}'), (('A', '-', 'x'), ('B', ':?', 'no B'), ('C', '?', '')))
+
+    def test_escaped_dollar_joins_the_literals(self):
+        self.assertEqual(compile_template('echo $$HOME $$'), ('echo $HOME $',))
+
+    def test_invalid(self):
+        for text in ('$1', 'a $ b', '${}', '${A B}', '${A'):
+            self.assertRaises(ComposeError, compile_template, text)
+
+
+class InterpolatorTest(unittest.TestCase):
+    def setUp(self):
+        self.interpolator = Interpolator({'TAG': '1.13', 'EMPTY': ''})
+
+    def test_substitute(self):
+        self.assertEqual(self.interpolator.substitute('nginx:$TAG'), 'nginx:1.13')
+        self.assertEqual(self.interpolator.substitute('nginx:${TAG}-alpine'), 'nginx:1.13-alpine')
+        self.assertEqual(self.interpolator.substitute('sh -c "echo $$HOME"'), 'sh -c "echo $HOME"')
+
+    def test_defaults(self):
+        self.assertEqual(self.interpolator.substitute('${MISSING:-a}${MISSING-b}'), 'ab')
+        self.assertEqual(self.interpolator.substitute('${EMPTY:-a}'), 'a')
+        self.assertEqual(self.interpolator.substitute('${EMPTY-a}'), '')
+        self.assertEqual(self.interpolator.substitute('${TAG:-a}'), '1.13')
+
+    def test_required(self):
+        with self.assertRaises(ComposeError) as context:
+            self.interpolator.substitute('${MISSING:?set MISSING}')
+        self.assertIn('set MISSING', str(context.exception))
+        self.assertRaises(ComposeError, self.interpolator.substitute, '${EMPTY:?}')
+        self.assertEqual(self.interpolator.substitute('${EMPTY?}'), '')
+
+    def test_missing_is_empty(self):
+        self.assertEqual(self.interpolator.substitute('a${MISSING}b'), 'ab')
+
+    def test_interpolate_copies_containers(self):
+        model = OrderedDict([('services', OrderedDict([('web', OrderedDict([('image', 'nginx:${TAG}'), ('ports', ['80:80', 8080])]))]))])
+        result = self.interpolator.interpolate(model)
+        self.assertEqual(result['services']['web'], OrderedDict([('image', 'nginx:1.13'), ('ports', ['80:80', 8080])]))
+        self.assertIsInstance(result['services'], OrderedDict)
+        self.assertEqual(model['services']['web']['image'], 'nginx:${TAG}')
+
+    def test_values_of_referenced_variables(self):
+        self.interpolator.substitute('$TAG ${MISSING:-x} no variables')
+        self.assertEqual(self.interpolator.values(), {'TAG': '1.13', 'MISSING': None})
+
+    def test_escape_variables(self):
+        self.assertEqual(escape_variables({'command': ['echo', '$HOME'], 'replicas': 2}), {'command': ['echo', '$$HOME'], 'replicas': 2})
+
+
+class LoadDotenvTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, '.env')
+        self.environ = dict(os.environ)
+        os.environ.pop('DOTENV_TEST_A', None)
+        os.environ.pop('DOTENV_TEST_B', None)
+        os.environ['DOTENV_TEST_REAL'] = 'real'
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.directory)
+
+    def write(self, text):
+        with open(self.path, 'w') as env_file:
+            env_file.write(text)
+
+    def test_environment_takes_precedence(self):
+        self.write('# comment\nDOTENV_TEST_A=1\n\nDOTENV_TEST_REAL=file\n')
+        self.assertEqual(load_dotenv(self.path), set(['DOTENV_TEST_A']))
+        self.assertEqual(os.environ['DOTENV_TEST_A'], '1')
+        self.assertEqual(os.environ['DOTENV_TEST_REAL'], 'real')
+
+    def test_reload_replaces_loaded_variables(self):
+        self.write('DOTENV_TEST_A=1\n')
+        loaded = load_dotenv(self.path)
+        self.write('DOTENV_TEST_B=2\n')
+        self.assertEqual(load_dotenv(self.path, loaded), set(['DOTENV_TEST_B']))
+        self.assertNotIn('DOTENV_TEST_A', os.environ)
+        self.assertEqual(os.environ['DOTENV_TEST_B'], '2')
+
+    def test_missing_file(self):
+        self.assertEqual(load_dotenv(os.path.join(self.directory, 'missing')), set())
+
+
+if __name__ == '__main__':
+    unittest.main()
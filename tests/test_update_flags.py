@@ -0,0 +1,98 @@
+# pylint: disable=locally-disabled, C0111, line-too-long
+
+"""Tests of the `docker service update` flags computed from the old and the new service spec.
+
+Run with `python -m unittest discover tests`.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from docker_compose_swarm_mode import service_flags_from_spec, spec_update_flags  # pylint: disable=wrong-import-position
+
+
+class SpecUpdateFlagsTest(unittest.TestCase):
+    def test_unchanged(self):
+        flags = [['--env', 'A=1'], ['--publish', '80:80'], ['--replicas', 2]]
+        self.assertEqual(spec_update_flags(flags, list(flags)), [])
+
+    def test_list_flags_are_added_and_removed_by_key(self):
+        old = [['--env', 'A=1'], ['--env', 'B=1'], ['--label', 'tier=front'], ['--constraint', 'node.role == manager'],
+               ['--mount', 'src=app_data,dst=/data,readonly=0'], ['--network', 'app_front']]
+        new = [['--env', 'A=2'], ['--env', 'C=1'], ['--constraint', 'node.role == worker'],
+               ['--mount', 'src=app_other,dst=/data,readonly=0'], ['--network', 'app_front'], ['--network', 'app_back']]
+        self.assertEqual(spec_update_flags(old, new), [
+            ['--env-rm', 'B'], ['--env-add', 'A=2'], ['--env-add', 'C=1'],
+            ['--label-rm', 'tier'],
+            ['--constraint-rm', 'node.role == manager'], ['--constraint-add', 'node.role == worker'],
+            ['--mount-add', 'src=app_other,dst=/data,readonly=0'],
+            ['--network-add', 'app_back']])
+
+    def test_changed_port_is_removed_before_it_is_added(self):
+        old = [['--publish', '10000:80'], ['--publish', '443:443']]
+        new = [['--publish', '10001:80'], ['--publish', '443:443'], ['--publish', 53]]
+        self.assertEqual(spec_update_flags(old, new), [['--publish-rm', '80'], ['--publish-add', '10001:80'], ['--publish-add', 53]])
+
+    def test_removed_port(self):
+        self.assertEqual(spec_update_flags([['--publish', '8080:80']], []), [['--publish-rm', '80']])
+
+    def test_single_valued_flags_are_set_and_reset(self):
+        old = [['--restart-condition', 'on-failure'], ['--limit-memory', '512m'], ['--hostname', 'web']]
+        new = [['--restart-condition', 'none'], ['--update-parallelism', 2]]
+        self.assertEqual(spec_update_flags(old, new), [
+            ['--restart-condition', 'none'], ['--limit-memory', '0'], ['--hostname', ''], ['--update-parallelism', 2]])
+
+    def test_flag_without_reset_is_kept(self):
+        self.assertEqual(spec_update_flags([['--replicas', 3]], []), [])
+
+    def test_log_options_are_replaced_with_the_driver(self):
+        old = [['--log-driver', 'syslog'], ['--log-opt', 'tag=web']]
+        new = [['--log-driver', 'syslog'], ['--log-opt', 'tag=app']]
+        self.assertEqual(spec_update_flags(old, new), [['--log-driver', 'syslog'], ['--log-opt', 'tag=app']])
+
+    def test_mode_is_not_changed(self):
+        self.assertEqual(spec_update_flags([], [['--mode', 'global']]), [])
+
+
+class ServiceFlagsFromSpecTest(unittest.TestCase):
+    def test_rebuilds_list_flags(self):
+        spec = {
+            'Name': 'app_web',
+            'Labels': {'tier': 'front'},
+            'Mode': {'Replicated': {'Replicas': 2}},
+            'TaskTemplate': {
+                'ContainerSpec': {'Image': 'nginx:1.13', 'Args': ['nginx', '-g', 'daemon off;'], 'Env': ['A=1'],
+                                  'Mounts': [{'Type': 'bind', 'Source': '/srv', 'Target': '/data', 'ReadOnly': True},
+                                             {'Type': 'volume', 'Source': 'app_data', 'Target': '/var'}],
+                                  'Hosts': ['10.0.0.2 db']},
+                'Placement': {'Constraints': ['node.role == manager']},
+                'Networks': [{'Target': 'id-front'}, {'Target': 'id-unknown'}],
+            },
+            'EndpointSpec': {'Ports': [{'Protocol': 'tcp', 'TargetPort': 80, 'PublishedPort': 8080},
+                                       {'Protocol': 'udp', 'TargetPort': 53}]},
+        }
+        flags, image, command = service_flags_from_spec(spec, {'id-front': 'app_front'})
+        self.assertEqual(image, 'nginx:1.13')
+        self.assertEqual(command, ['nginx', '-g', 'daemon off;'])
+        self.assertEqual(flags, [
+            ['--env', 'A=1'], ['--label', 'tier=front'], ['--constraint', 'node.role == manager'],
+            ['--mount', 'type=bind,src=/srv,dst=/data,readonly=1'], ['--mount', 'src=app_data,dst=/var,readonly=0'],
+            ['--publish', '8080:80'], ['--publish', '53/udp'],
+            ['--network', 'app_front'], ['--network', 'id-unknown'],
+            ['--host', 'db:10.0.0.2']])
+
+    def test_global_mode(self):
+        flags, image, command = service_flags_from_spec({'Mode': {'Global': {}}, 'TaskTemplate': {'ContainerSpec': {'Image': 'agent'}}}, {})
+        self.assertEqual((flags, image, command), ([['--mode', 'global']], 'agent', []))
+
+    def test_attached_networks_are_not_added_again(self):
+        spec = {'TaskTemplate': {'ContainerSpec': {'Image': 'nginx', 'Env': ['A=1']}, 'Networks': [{'Target': 'id-front'}]}}
+        old_flags, _, _ = service_flags_from_spec(spec, {'id-front': 'app_front'})
+        self.assertEqual(spec_update_flags(old_flags, [['--network', 'app_front'], ['--env', 'A=2']]), [['--env-add', 'A=2']])
+
+
+if __name__ == '__main__':
+    unittest.main()